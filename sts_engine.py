@@ -0,0 +1,170 @@
+"""Asyncio sessions to drive uci and winboard engines.
+
+Used by sts_rating.py and tools/analyze.py. Every read from the engine
+has a deadline, an engine that goes silent raises EngineTimeout and an
+engine that exits or closes its output raises EngineTerminated. Many
+sessions can run in one event loop without a thread per pipe.
+"""
+
+
+import asyncio
+import os
+import time
+
+
+INIT_TIMEOUT = 30  # sec, uci to uciok
+SYNC_TIMEOUT = 60  # sec, isready to readyok, ucinewgame may clear a big hash
+QUIT_TIMEOUT = 5  # sec, wait for the engine to exit after quit
+
+
+class EngineError(Exception):
+    """Base class of the engine session errors."""
+
+
+class EngineTimeout(EngineError):
+    """The engine did not reply before the deadline."""
+
+
+class EngineTerminated(EngineError):
+    """The engine process exited or closed its output."""
+
+
+def get_deadline(timeout):
+    """Returns the absolute deadline of a timeout in sec, None if timeout is None."""
+    if timeout is None:
+        return None
+    return time.monotonic() + timeout
+
+
+class EngineSession:
+    """A running engine process with line based input and output.
+
+    Args:
+      enginefn: The engine filename or path/filename.
+      log: Optional function that is called with every line sent,
+        prefixed by '>> ', and every line received, prefixed by '<< '.
+      cpus: Optional cpu numbers the engine process and its threads are
+        pinned to, Linux only.
+    """
+
+    def __init__(self, enginefn, log=None, cpus=None):
+        self.enginefn = enginefn
+        self.log = log
+        self.cpus = cpus
+        self.proc = None
+        self.id_name = None
+        self.options = set()
+
+    async def start(self):
+        """Runs the engine process."""
+        preexec_fn = None
+        if self.cpus:
+            # Set in the child before exec, the engine threads inherit it.
+            cpus = set(self.cpus)
+            preexec_fn = lambda: os.sched_setaffinity(0, cpus)  # noqa: E731
+
+        try:
+            self.proc = await asyncio.create_subprocess_exec(
+                self.enginefn, stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                limit=1 << 20, preexec_fn=preexec_fn)
+        except OSError as err:
+            raise EngineTerminated(f'cannot start {self.enginefn}: {err}') from err
+
+    @property
+    def returncode(self):
+        """The exit code of the engine or None if it is still running."""
+        return None if self.proc is None else self.proc.returncode
+
+    async def send(self, line):
+        """Sends a command line to the engine."""
+        if self.log is not None:
+            self.log(f'>> {line}')
+        try:
+            self.proc.stdin.write((line + '\n').encode())
+            await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError) as err:
+            raise EngineTerminated(f'{self.enginefn} does not accept input') from err
+
+    async def readline(self, deadline=None):
+        """Returns the next line from the engine.
+
+        Args:
+          deadline: Absolute time from get_deadline() or None to wait
+            without limit.
+        """
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise EngineTimeout(f'{self.enginefn} did not reply in time')
+
+        try:
+            raw = await asyncio.wait_for(self.proc.stdout.readline(), timeout)
+        except asyncio.TimeoutError as err:
+            raise EngineTimeout(f'{self.enginefn} did not reply in time') from err
+        except ValueError as err:
+            # The line is longer than the stream limit.
+            raise EngineTerminated(f'{self.enginefn} sent an invalid line') from err
+
+        if not raw:
+            raise EngineTerminated(f'{self.enginefn} terminated')
+
+        line = raw.decode(errors='replace').strip()
+        if self.log is not None:
+            self.log(f'<< {line}')
+        return line
+
+    async def uci(self, timeout=INIT_TIMEOUT):
+        """Sends uci and reads the engine id name and options until uciok.
+
+        Returns the engine id name.
+        """
+        deadline = get_deadline(timeout)
+        await self.send('uci')
+        while True:
+            line = await self.readline(deadline)
+            if line.startswith('id name '):
+                self.id_name = line[len('id name '):].strip()
+            elif line.startswith('option name '):
+                name = line[len('option name '):].split(' type ')[0].strip()
+                self.options.add(name)
+            elif line == 'uciok':
+                return self.id_name
+
+    async def setoption(self, name, value):
+        """Sends the uci setoption command."""
+        await self.send(f'setoption name {name} value {value}')
+
+    async def isready(self, timeout=SYNC_TIMEOUT):
+        """Sends isready and waits for readyok."""
+        deadline = get_deadline(timeout)
+        await self.send('isready')
+        while True:
+            line = await self.readline(deadline)
+            if line == 'readyok':
+                return
+
+    async def quit(self, timeout=QUIT_TIMEOUT):
+        """Sends quit and waits for the engine to exit, kills it if it does not."""
+        if self.proc is None or self.proc.returncode is not None:
+            return
+
+        try:
+            await self.send('quit')
+        except EngineTerminated:
+            pass
+
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.kill()
+            await self.proc.wait()
+
+    def kill(self):
+        """Kills the engine process."""
+        if self.proc is not None and self.proc.returncode is None:
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,183 @@
+"""Index of the sts positions by a hash of the canonical fen.
+
+Used by sts_rating.py and tools/analyze.py. The index is built from all
+the epd files in the epd folder, sts_google_sheet.epd gives the index of
+the position in the sts_positions google sheet and the other files give
+the sts ids. Positions are matched by their canonical fen, so the
+whitespace, the castling rights, the en passant square and the opcodes
+or move counters after the fen do not matter. The index is saved in the
+epd folder and built again when an epd file is changed.
+"""
+
+
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+
+EPD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'epd')
+SHEET_EPD = 'sts_google_sheet.epd'
+INDEX_FN = 'position_index.json'
+INDEX_FORMAT = 1
+
+IndexEntry = namedtuple('IndexEntry', ['sheet_index', 'sts_ids'])
+
+
+def get_canonical_fen(epd):
+    """Returns the piece placement, side, castling and en passant fields of an epd or fen.
+
+    The castling rights without the king and rook on their squares and an
+    en passant square without a pawn that can capture are removed, like
+    the fen of python chess.
+    """
+    fields = epd.split()
+    board = fields[0]
+    side = fields[1].lower() if len(fields) > 1 else 'w'
+    castling = fields[2] if len(fields) > 2 else '-'
+    ep = fields[3] if len(fields) > 3 else '-'
+
+    # 64 squares from a8 to h1
+    squares = []
+    for c in board:
+        if c.isdigit():
+            squares.extend('.' * int(c))
+        elif c != '/':
+            squares.append(c)
+    if len(squares) != 64:
+        raise ValueError(f'invalid fen board: {board}')
+
+    def piece(sq):
+        return squares[(8 - int(sq[1])) * 8 + 'abcdefgh'.index(sq[0])]
+
+    rights = {'K': ('e1', 'K', 'h1', 'R'), 'Q': ('e1', 'K', 'a1', 'R'),
+              'k': ('e8', 'k', 'h8', 'r'), 'q': ('e8', 'k', 'a8', 'r')}
+    castling = ''.join(c for c in 'KQkq' if c in castling
+                       and piece(rights[c][0]) == rights[c][1]
+                       and piece(rights[c][2]) == rights[c][3]) or '-'
+
+    if ep != '-':
+        pawn, rank, capture_rank = ('P', '6', '5') if side == 'w' else ('p', '3', '4')
+        them = 'p' if pawn == 'P' else 'P'
+        file = ep[0]
+        captures = [f + capture_rank for f in 'abcdefgh'
+                    if abs(ord(f) - ord(file)) == 1 and piece(f + capture_rank) == pawn]
+        if len(ep) != 2 or ep[1] != rank or piece(file + capture_rank) != them or not captures:
+            ep = '-'
+
+    rows = []
+    for r in range(8):
+        row, empty = '', 0
+        for c in squares[8*r:8*r + 8]:
+            if c == '.':
+                empty += 1
+                continue
+            if empty:
+                row += str(empty)
+                empty = 0
+            row += c
+        rows.append(row + (str(empty) if empty else ''))
+
+    return ' '.join(['/'.join(rows), side, castling, ep])
+
+
+def get_position_key(epd):
+    """Returns the 64 bit hash of the canonical fen as 16 hex digits."""
+    return hashlib.blake2b(get_canonical_fen(epd).encode(), digest_size=8).hexdigest()
+
+
+def get_epd_id(line):
+    """Returns the id opcode of an epd line, None if it has none."""
+    start = line.find(' id "')
+    if start < 0:
+        return None
+    start += len(' id "')
+    return line[start:line.index('"', start)]
+
+
+class PositionIndex:
+    """The sheet index and sts ids of positions by their position key."""
+
+    def __init__(self, positions=None):
+        self.positions = positions if positions is not None else {}
+
+    def add(self, epd, sheet_index=None, sts_id=None):
+        """Adds the sheet index or sts id of a position."""
+        entry = self.positions.setdefault(get_position_key(epd), [None, []])
+        if sheet_index is not None:
+            entry[0] = sheet_index
+        if sts_id is not None and sts_id not in entry[1]:
+            entry[1].append(sts_id)
+
+    def lookup(self, epd):
+        """Returns the IndexEntry of the epd or fen, None if it is not found."""
+        try:
+            entry = self.positions.get(get_position_key(epd))
+        except (ValueError, IndexError):
+            return None
+        if entry is None:
+            return None
+        return IndexEntry(entry[0], tuple(entry[1]))
+
+    def __len__(self):
+        return len(self.positions)
+
+
+def get_sources(epd_dir):
+    """Returns the size and modified time of every epd file in the folder."""
+    sources = {}
+    for fn in sorted(os.listdir(epd_dir)):
+        if fn.lower().endswith('.epd'):
+            st = os.stat(os.path.join(epd_dir, fn))
+            sources[fn] = [st.st_size, int(st.st_mtime)]
+    return sources
+
+
+def build_position_index(epd_dir, sources):
+    """Returns the PositionIndex of the epd files in sources."""
+    index = PositionIndex()
+    for fn in sources:
+        with open(os.path.join(epd_dir, fn), encoding='utf-8') as f:
+            number = 0
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                number += 1
+                if fn == SHEET_EPD:
+                    index.add(line, sheet_index=number)
+                else:
+                    index.add(line, sts_id=get_epd_id(line))
+    return index
+
+
+def load_position_index(epd_dir=EPD_DIR):
+    """Returns the PositionIndex of the epd folder.
+
+    The saved index is used if the epd files are not changed since it was
+    built, else it is built and saved again. An empty index is returned
+    if the folder is not found.
+    """
+    try:
+        sources = get_sources(epd_dir)
+    except OSError:
+        return PositionIndex()
+
+    index_path = os.path.join(epd_dir, INDEX_FN)
+    try:
+        with open(index_path, encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved.get('format') == INDEX_FORMAT and saved.get('sources') == sources:
+            return PositionIndex(saved['positions'])
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    index = build_position_index(epd_dir, sources)
+    try:
+        with open(index_path, 'w', encoding='utf-8') as f:
+            json.dump({'format': INDEX_FORMAT, 'sources': sources,
+                       'positions': index.positions}, f, separators=(',', ':'))
+    except OSError:
+        pass
+
+    return index
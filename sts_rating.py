@@ -8,9 +8,27 @@ __version__ = '14.2'
 import sys
 import getopt
 import os
-import subprocess
 import time, datetime
+import platform
+import threading
+import queue
+import asyncio
+import csv
+import hashlib
+import json
+import sqlite3
+import math
+import random
+import glob
+import gzip
+import atexit
 import timeit
+import shutil
+from collections import OrderedDict, namedtuple
+
+from sts_engine import EngineSession, EngineError, EngineTimeout, get_deadline
+from sts_stats import bootstrap_scores, load_numpy
+from sts_positions import load_position_index, get_position_key
 
 
 # Constants
@@ -40,9 +58,90 @@ STS_TITLE = ['Undermining',
              ]
 
 
+# Position record of the epd file, moves and points are tuples, number is
+# the position number in its theme, sheet is the index in the sts_positions
+# google sheet or None
+EpdPosition = namedtuple('EpdPosition', ['fen', 'stsId', 'name', 'sanMoves', 'lanMoves',
+                                         'points', 'epd', 'number', 'sheet'])
+
+
+# Fields of a uci info line that are used, None if not in the line
+InfoLine = namedtuple('InfoLine', ['depth', 'time', 'nodes', 'cp', 'mate'])
+
+# Engine answer of a position, score is None if there is no cp score
+# and mate is None if there is no mate score
+EngineAnswer = namedtuple('EngineAnswer', ['bestMove', 'score', 'mate', 'depth', 'time',
+                                           'nodes'])
+
+
 # Global result file name
 resultFN = "STS_Rating.txt"
 
+# Rating estimate from the score percent, CCRL 40/4
+RATING_SLOPE = 44.523
+RATING_INTERCEPT = -242.85
+
+# Position transition of uci engines. Full sends isready and ucinewgame,
+# hash sends isready only and pipeline sends the next position right after
+# the bestmove.
+RESET_FULL = 'full'
+RESET_HASH = 'hash'
+RESET_PIPELINE = 'pipeline'
+
+# Time in sec that an engine may exceed its search limit before it is
+# considered as hung, nodes and depth limits get a fixed timeout
+SEARCH_TIMEOUT_MARGIN = 10
+SEARCH_TIMEOUT_NO_CLOCK = 600
+
+# Early stop with --precision, the positions are analyzed in a random order
+# that is the same in every run. The interval is 95%, every theme needs
+# some positions before its variance is used.
+SAMPLE_SEED = 1
+CONFIDENCE_Z = 1.96
+MIN_THEME_SAMPLES = 10
+
+# Time budget with --budget, a short warm-up measures the time per position
+# beyond the movetime
+WARMUP_POSITIONS = 5
+WARMUP_MOVETIME = 100  # ms
+MIN_MOVETIME = 50  # ms
+
+# Placement of the engine instances with --affinity
+AFFINITY_CORE = 'core'
+AFFINITY_NUMA = 'numa'
+
+# Number of times a position is tried again after the engine is restarted
+MAX_RETRIES = 2
+
+# Computer speed calibration for --getrating. The analysis time is
+# RATING_ANALYSIS_TIME in the reference computer (intel i7-2600k). It is
+# scaled by the nps of the reference engine in this computer against its
+# nps in the reference computer. The reference engine is REF_ENGINE from
+# the PATH or --refengine. Without a reference engine the time of the
+# python bench against BENCH_REF_TIME is used. The nps and the bench are
+# saved per computer in CALIBRATION_FN so that every run gets the same
+# analysis time. All engines of a run get the same analysis time.
+RATING_ANALYSIS_TIME = 200  # ms
+REF_ENGINE = 'stockfish'
+REF_ENGINE_NAME = 'Stockfish 15'
+REF_NPS = 800000  # Stockfish 15 on one thread in intel i7-2600k
+BENCH_REF_TIME = 2.5534  # sec in intel i7-2600k
+CALIBRATION_FN = "sts_calibration.json"
+CALIBRATION_MOVETIME = 1000  # ms
+
+# Columns of the csv result stream, position and summary records
+STREAM_FIELDS = ['type', 'sts', 'index', 'sheet', 'id', 'fen', 'move', 'rank', 'points', 'score',
+                 'mate', 'depth', 'time', 'nodes', 'sync', 'wall', 'parse', 'title',
+                 'positions', 'maxpoints', 'percent', 'bestcount', 'rating']
+
+# Log of --log, text is written by a background thread after every position
+# or when this size is buffered
+LOG_BUFFER_SIZE = 1 << 20
+
+# Cache of engine answers
+CACHE_FN = "sts_cache.db"
+CACHE_MAX_ENTRIES = 500000
+
 
 def delete_file(input_fn):
     """ Delete fn file if it exists """
@@ -55,17 +154,381 @@ def ShowPlatform(title):
     print(title)
 
 
+def get_percentile(values, pct):
+    """ Returns the pct percentile of sorted values """
+    i = int(round(pct/100.0*(len(values) - 1)))
+    return values[i]
+
+
+def get_stratified_order(suite, seed):
+    """ Returns the positions as (idItem, posIndex, epdPos), shuffled per theme and
+    taken from the themes in turn
+    """
+    rng = random.Random(seed)
+    themes = []
+    for idItem, positions in suite.items():
+        items = [(idItem, epdPos.number, epdPos) for epdPos in positions]
+        rng.shuffle(items)
+        themes.append(items)
+
+    order = []
+    for i in range(max([len(items) for items in themes] + [0])):
+        for items in themes:
+            if i < len(items):
+                order.append(items[i])
+    return order
+
+
+def get_confidence_interval(themeResult, themeSize, maxPoints):
+    """ Returns the score percent and the half width of its confidence interval
+
+    The score is the stratified mean of the themes, themeSize has the number
+    of positions of every theme. Returns None if a theme has less than
+    MIN_THEME_SAMPLES positions analyzed.
+    """
+    mean = 0.0
+    variance = 0.0
+    total = sum(themeSize.values())
+    for idItem, size in themeSize.items():
+        if not size:
+            continue
+        n, points = themeResult[idItem][0:2]
+        sumSq = themeResult[idItem][5]
+        if n < min(MIN_THEME_SAMPLES, size):
+            return None
+
+        w = float(size)/total
+        m = float(points)/n
+        mean += w*m
+        if 1 < n < size:
+            s2 = max(0.0, (sumSq - n*m*m)/(n - 1))
+            variance += w*w*s2/n*(1 - float(n)/size)
+
+    scale = 100.0/maxPoints
+    return scale*mean, scale*CONFIDENCE_Z*math.sqrt(variance)
+
+
+def parse_number_list(numberList):
+    """ Returns the numbers of a list such as 0-7,16-23, also used for Linux cpu lists """
+    numbers = []
+    for part in numberList.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            numbers.extend(range(int(first), int(last) + 1))
+        elif part:
+            numbers.append(int(part))
+    return numbers
+
+
+def format_cpu_list(cpus):
+    """ Returns the cpu numbers as a Linux cpu list such as 0-7,16-23 """
+    parts = []
+    for cpu in sorted(cpus):
+        if parts and cpu == parts[-1][1] + 1:
+            parts[-1][1] = cpu
+        else:
+            parts.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '%d-%d' % (a, b) for a, b in parts)
+
+
+def get_numa_nodes():
+    """ Returns the usable cpus of every NUMA node, all usable cpus in one node
+    if the system has no NUMA information
+    """
+    usable = os.sched_getaffinity(0)
+    nodes = []
+    paths = glob.glob('/sys/devices/system/node/node*/cpulist')
+    for path in sorted(paths, key=lambda x: int(x.split('/')[-2][4:])):
+        with open(path) as f:
+            cpus = [cpu for cpu in parse_number_list(f.read()) if cpu in usable]
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(usable)]
+
+
+def get_core_sets(concurrency, threadsv, mode):
+    """ Returns the cpus of every engine instance, threadsv cpus per instance
+
+    Mode core packs the instances on the usable cpus, mode numa takes the
+    NUMA nodes in turn so that every instance is in one node. Cpus are
+    shared when there are not enough of them.
+    """
+    if mode == AFFINITY_NUMA:
+        nodes = get_numa_nodes()
+    else:
+        nodes = [sorted(os.sched_getaffinity(0))]
+
+    nextCpu = [0]*len(nodes)
+    coreSets = []
+    for i in range(concurrency):
+        n = i % len(nodes)
+        cpus = nodes[n]
+        size = min(threadsv, len(cpus))
+        if nextCpu[n] + size > len(cpus):
+            # Not enough cpus left in the node, start again from its first cpu
+            nextCpu[n] = 0
+        coreSets.append(cpus[nextCpu[n]:nextCpu[n] + size])
+        nextCpu[n] += size
+    return coreSets
+
+
 def get_score_percent_key(item):
     """ Sort time """
     return item[3]
 
 
-def count_positions(fname):
-    """ Returns number of lines in a file """
-    with open(fname) as f:
-        for i, l in enumerate(f):
-            pass
-    return i + 1
+def get_file_hash(fname):
+    """ Returns the sha1 of file content or the name if it is not a file """
+    if not os.path.isfile(fname):
+        return hashlib.sha1(fname.encode()).hexdigest()
+
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """ Engine answers saved in an sqlite file
+
+    The key is the sha1 of the engine binary hash, engine options, search
+    limit, reset policy and the fen. The answers of the hash and pipeline
+    policies depend on the previous search, so every policy has its own
+    answers. Entries that were not used recently are deleted
+    when the number of entries is more than maxEntries.
+    """
+
+    def __init__(self, fname, engineHash, options, limit, resetPolicy, maxEntries, refresh):
+        self.maxEntries = maxEntries
+        self.refresh = refresh
+        self.prefix = '%s|%s|%s|%s|' % (engineHash, options, limit, resetPolicy)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(fname, check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.con.execute('CREATE TABLE IF NOT EXISTS answers ('
+                         'key TEXT PRIMARY KEY, bestmove TEXT, score INTEGER, '
+                         'mate INTEGER, depth INTEGER, time INTEGER, used REAL)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS answers_used ON answers(used)')
+        columns = [row[1] for row in self.con.execute('PRAGMA table_info(answers)')]
+        if 'nodes' not in columns:
+            self.con.execute('ALTER TABLE answers ADD COLUMN nodes INTEGER')
+        self.con.commit()
+
+    def get_key(self, fen):
+        return hashlib.sha1((self.prefix + fen).encode()).hexdigest()
+
+    def get(self, fen):
+        """ Returns the saved EngineAnswer or None """
+        if self.refresh:
+            self.misses += 1
+            return None
+
+        key = self.get_key(fen)
+        with self.lock:
+            row = self.con.execute('SELECT bestmove, score, mate, depth, time, nodes FROM answers '
+                                   'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.con.execute('UPDATE answers SET used = ? WHERE key = ?', (time.time(), key))
+            self.con.commit()
+
+        return EngineAnswer(*row)
+
+    def put(self, fen, answer):
+        if answer.bestMove is None:
+            return
+
+        with self.lock:
+            self.con.execute('INSERT OR REPLACE INTO answers (key, bestmove, score, mate, depth, '
+                             'time, nodes, used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (self.get_key(fen),) + tuple(answer) + (time.time(),))
+            self.con.commit()
+
+    def close(self):
+        """ Delete the least recently used entries and close the file """
+        with self.lock:
+            n = self.con.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+            if n > self.maxEntries:
+                self.con.execute('DELETE FROM answers WHERE key IN (SELECT key FROM answers '
+                                 'ORDER BY used LIMIT ?)', (n - self.maxEntries,))
+                self.con.commit()
+            self.con.close()
+
+
+class ResultStream:
+    """ Position and summary records written as json lines or csv while the test runs """
+
+    def __init__(self, fname):
+        self.isCsv = fname.lower().endswith('.csv')
+        self.fo = open(fname, 'w', newline='' if self.isCsv else None)
+        if self.isCsv:
+            self.writer = csv.DictWriter(self.fo, fieldnames=STREAM_FIELDS,
+                                         extrasaction='ignore')
+            self.writer.writeheader()
+
+    def write(self, rec):
+        if self.isCsv:
+            self.writer.writerow(rec)
+        else:
+            self.fo.write(json.dumps(rec) + '\n')
+        self.fo.flush()
+
+    def close(self):
+        self.fo.close()
+
+
+class TimeBudget:
+    """ Movetime of uci engines that fits the positions into a wall clock budget
+
+    The movetime is reduced if the run falls behind, and if the positions do
+    not fit even at MIN_MOVETIME the last positions in the job queues are
+    dropped. The queues are in stratified order so all themes are kept.
+    """
+
+    def __init__(self, seconds, timeStart):
+        self.seconds = seconds
+        self.deadline = timeStart + seconds
+        self.movetime = MIN_MOVETIME
+        self.concurrency = 1
+        self.overhead = 0.0
+        self.queues = []
+        self.minUsed = None
+        self.maxUsed = None
+        self.trimmed = 0
+
+    def plan(self, numPositions, overhead, concurrency):
+        """ Returns the movetime in ms that fits numPositions with the given overhead in ms """
+        self.overhead = overhead
+        self.concurrency = concurrency
+        left = self.deadline - time.perf_counter()
+        self.movetime = max(MIN_MOVETIME, int(1000*left*concurrency/max(1, numPositions) - overhead))
+        return self.movetime
+
+    def add_queue(self, jobQueue):
+        self.queues.append(jobQueue)
+
+    def get_uci_limit(self):
+        """ Returns the go command limit of the next position """
+        remaining = sum(q.qsize() for q in self.queues) + 1
+        left = max(0.0, self.deadline - time.perf_counter())
+        movetime = min(self.movetime, int(1000*left*self.concurrency/remaining - self.overhead))
+        if movetime < MIN_MOVETIME:
+            movetime = MIN_MOVETIME
+            keep = int(1000*left*self.concurrency/(MIN_MOVETIME + self.overhead))
+            self.trim(max(0, keep - 1))
+
+        if self.minUsed is None or movetime < self.minUsed:
+            self.minUsed = movetime
+        if self.maxUsed is None or movetime > self.maxUsed:
+            self.maxUsed = movetime
+        return 'movetime %d' % movetime
+
+    def trim(self, keep):
+        """ Keep the first positions of every job queue, keep positions in total """
+        remaining = sum(q.qsize() for q in self.queues)
+        if keep >= remaining:
+            return
+        for q in self.queues:
+            jobs = list(iter(lambda: get_job(q), None))
+            n = int(len(jobs)*float(keep)/remaining)
+            for job in jobs[:n]:
+                q.put(job)
+            self.trimmed += len(jobs) - n
+
+
+class DebugLog:
+    """ Log file of --log, written by a background thread so that the engines are not slowed
+
+    Engine lines are timestamped with the monotonic clock in sec from the
+    start of the log. The positions that are not solved are added to
+    notSolvedFn as they are found. The log is also closed at exit so that
+    an interrupted run keeps what is logged.
+    """
+
+    def __init__(self, fname, notSolvedFn, compress):
+        self.notSolvedFn = notSolvedFn
+        self.notSolvedFO = None
+        self.closed = False
+        self.buf = []
+        self.size = 0
+        self.t0 = time.monotonic()
+        if compress:
+            fo = gzip.open(fname + '.gz', 'wt', compresslevel=1)
+        else:
+            fo = open(fname, 'w')
+        self.batches = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.write_batches, args=(fo,), daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def write_batches(self, fo):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            fo.write(batch)
+            fo.flush()
+        fo.close()
+
+    def write(self, text):
+        self.buf.append(text)
+        self.size += len(text)
+        if self.size >= LOG_BUFFER_SIZE:
+            self.flush()
+
+    def engine(self, line):
+        """ Log a line sent to or received from the engine """
+        self.write("%0.6f %s\n" %(time.monotonic() - self.t0, line))
+
+    def add_unsolved(self, pos):
+        """ Save a position that is not solved """
+        if self.notSolvedFO is None:
+            self.notSolvedFO = open(self.notSolvedFn, 'w')
+        self.notSolvedFO.write(pos + '\n')
+        self.notSolvedFO.flush()
+
+    def flush(self):
+        if self.buf:
+            self.batches.put(''.join(self.buf))
+            self.buf = []
+            self.size = 0
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.batches.put(None)
+        self.writer.join()
+        if self.notSolvedFO is not None:
+            self.notSolvedFO.close()
+
+
+class WorkerLog:
+    """ The DebugLog of one engine instance, its lines start with the instance number """
+
+    def __init__(self, log, worker):
+        self.log = log
+        self.tag = '[%d] ' % worker
+
+    def write(self, text):
+        self.log.write(self.tag + text)
+
+    def engine(self, line):
+        """ Log a line sent to or received from the engine """
+        self.log.engine(self.tag + line)
+
+    def add_unsolved(self, pos):
+        self.log.add_unsolved(pos)
+
+    def flush(self):
+        self.log.flush()
 
 
 def usage():
@@ -77,8 +540,43 @@ def usage():
    print("-h or --hash <integer value>, hash size in MB, default is 32 MB")
    print("-t or --threads <integer value>, for threads, Cores and Max CPUs setting")
    print("--movetime <integer value>, time in ms, default is 1000ms")
+   print("--nodes <integer value>, search nodes per position for uci engines,")
+   print("  used instead of movetime")
+   print("--depth <integer value>, search depth per position for uci engines,")
+   print("  used instead of movetime")
+   print("--reset <full, hash or pipeline>, what uci engines get before a position,")
+   print("  full sends isready and ucinewgame, hash sends isready only to keep the hash,")
+   print("  pipeline sends the next position right after bestmove, default is full")
+   print("--retries <integer value>, number of times a position is tried again when the")
+   print("  engine hangs or terminates, the engine is restarted, default is %d" % MAX_RETRIES)
+   print("--precision <float value>, analyze the positions in a random order that takes")
+   print("  every theme in turn and stop when the 95% interval of the rating estimate")
+   print("  is within +/- this value, e.g. --precision 10")
+   print("--bootstrap <integer value>, add the 95% bootstrap interval of the score percent")
+   print("  and rating of every theme to the result, e.g. --bootstrap 10000, needs numpy")
+   print("--rescore <string value>, score the engine moves of a journal or stream file")
+   print("  against the positions of the epd file without running the engine, the")
+   print("  positions are matched by fen, e.g. --rescore sf_journal.jsonl")
+   print("--budget <HH:MM>, fit the run into this wall clock time, a short warm-up")
+   print("  measures the overhead per position, then the movetime and the concurrency")
+   print("  (all cores if --concurrency is not given) are chosen, the movetime is reduced")
+   print("  or positions of all themes are dropped if the run falls behind, uci only")
+   print("--affinity <core or numa>, pin every engine instance to its own cpus, as many")
+   print("  as the threads, core packs the instances and numa keeps every instance in")
+   print("  one NUMA node, the nps per cpu set is in the result, Linux only")
+   print("--themes <list of theme numbers>, analyze only these themes, e.g. --themes 1,5,12")
+   print("  or --themes 11, the result has only the columns of these themes")
+   print("--positions <list of position numbers or sample:N>, analyze only these positions")
+   print("  of every theme, e.g. --positions 1-20 or --positions sample:25 for 25 random")
+   print("  positions of every theme")
    print("--log, save engine log")
+   print("--log-gzip, save engine log compressed with gzip")
    print("--getrating, calculate CCRL 40/4 rating estimate for uci engines only")
+   print("--refengine <string value>, engine used to measure the speed of this computer")
+   print("  for --getrating, default is %s from the PATH, without it a python bench is used" % REF_ENGINE)
+   print("--refnps <integer value>, nps of the --refengine on one thread in the reference")
+   print("  computer (intel i7-2600k), not needed for %s, default is %d" % (REF_ENGINE_NAME, REF_NPS))
+   print("--recalibrate, measure the speed of this computer again instead of using the saved value")
    print("--mps <integer value>, moves per session for winboard engines")
    print("--tc <integer value in minutes or mm:ss>, timce control for winboard engines")
    print("--st <integer or float value>, for winboard engines and")
@@ -87,6 +585,17 @@ def usage():
    print("--san, will read engine move in SAN format, only for WB engines")
    print("--contempt, for uci engines that supports such option")
    print("--maxpoint, the max point in the position, default is 10")
+   print("--engines <string value>, comma separated engines to compare, the engines share")
+   print("  the --concurrency instances, one after the other, and a comparison of the")
+   print("  score percent and rating estimate of every engine is added to the result file")
+   print("--concurrency <integer value>, number of engine instances that analyze")
+   print("  the positions in parallel, default is 1")
+   print("--no-cache, do not read or save engine answers in %s" % CACHE_FN)
+   print("--refresh, analyze all positions again and update the saved answers")
+   print("--cache-size <integer value>, max number of saved answers, default is %d" % CACHE_MAX_ENTRIES)
+   print("--resume, continue the run saved in <engine>_journal.jsonl")
+   print("--stream <string value>, write a record per position and a summary per sts")
+   print("  while the test runs, csv if the filename ends with .csv else json lines")
    
    print("\nExample:")
    print('Ex1. Analyze test.epd with 2 threads and 128 MB hash, at 3s/pos using sf 6.exe')
@@ -96,10 +605,870 @@ def usage():
    print('STS_Rating -f "all sts.epd" -e sf6.exe -h 128 --getrating\n')
 
 
-def analyze_pos(inFile, engineName, hashv, threadsv, stime, debug, numberOfPositions,
+def get_engine_log(debug, logfnFO):
+    """ Returns the function that saves the engine input and output in the log file """
+    if not debug:
+        return None
+    return logfnFO.engine
+
+
+async def start_engine(engineName, proto, hashv, threadsv, contemptOption, debug, logfnFO,
+                       cpus=None):
+    """ Run the engine and send init commands, returns engine session and engine id name
+
+    The session is None if the winboard engine does not support setboard.
+    The engine is pinned to the cpus if it is not None.
+    """
+    session = EngineSession(engineName, get_engine_log(debug, logfnFO), cpus)
+    await session.start()
+    print("Starting engine " + engineName + " ...")
+
+    if debug:
+        logfnFO.write("Starting engine " + engineName + " ...\n")  
+
+    ENG_ID_NAME = "engine name"
+
+    # Parse winboard engine output
+    if proto == WB:
+        waitTime = 30
+        if debug:
+            print('Set wait time to %ds' % waitTime)
+            logfnFO.write('Set wait time to %ds\n' % waitTime)
+        await session.send("xboard")
+
+        bSupportSetboard = False
+        wbt1 = time.monotonic()
+        ENG_ID_NAME = engineName[:-4]
+        ENG_ID_NAME = ENG_ID_NAME.strip()
+        
+        await session.send("protover 2")
+
+        # Parse engine output until done=1 or the wait time is over
+        try:
+            while True:
+                eline = await session.readline(wbt1 + waitTime)
+
+                # Print in console
+                if debug:
+                    print('<< %s' % eline)
+
+                if "done=0" in eline:
+                    print('Receive done=0')
+                    waitTime = waitTime*3
+                    print('Increase wait time to %ds' % waitTime)             
+                    if debug:
+                        logfnFO.write("Received done=0\n")
+                        logfnFO.write('Increase wait time to %ds\n' % waitTime)
+                if "setboard=1" in eline:
+                    bSupportSetboard = True
+                    if debug:
+                        print('Received setboard=1')
+                        logfnFO.write("Received setboard=1\n")
+                if "done=1" in eline:
+                    if debug:
+                        print('Received done=1')
+                        print('Stop parsing engine init output')
+                        logfnFO.write('Received done=1\n')
+                        logfnFO.write('Stop parsing engine init output\n')
+                    break             
+        except EngineTimeout:
+            if debug:
+                print('Did not received done=1 after %ds' % waitTime)
+                print('Stop parsing engine init output')
+                logfnFO.write('Did not received done=1 after %ds\n' % waitTime)
+                logfnFO.write('Stop parsing engine init output\n')
+
+        # Exit if winboard engine does not support setboard command
+        if not bSupportSetboard:
+            await session.quit()
+
+            if debug:
+                logfnFO.write("setboard command is not supported\n")
+                logfnFO.write("quit engine\n")
+
+            print('setboard command is not supported')
+            print('quit the engine')
+            return None, ENG_ID_NAME
+
+        await session.send("post")
+        await session.send("new")
+        await session.send("hard")
+        await session.send("easy")
+
+    else: # Uci
+        idName = await session.uci()
+        if idName:
+            ENG_ID_NAME = idName
+            print("id name: %s\n\n" %(ENG_ID_NAME))
+
+        await session.setoption("Hash", hashv)
+        await session.setoption("Contempt", contemptOption)
+
+        # Set threads, cores and max cpus
+        await session.setoption("Threads", threadsv)
+        await session.setoption("Cores", threadsv)
+        await session.setoption("Max CPUs", threadsv)
+        if debug:
+            logfnFO.write("\n")
+
+    return session, ENG_ID_NAME
+
+
+def parse_epd_opcodes(operations):
+    """ Returns a dict of opcode and operand from the epd operations """
+    opcodes = {}
+    for op in operations.split(';'):
+        op = op.strip()
+        if not op:
+            continue
+        name, _, operand = op.partition(' ')
+        opcodes[name] = operand.strip().strip('"')
+
+    return opcodes
+
+
+def get_position_filter(spec):
+    """ Returns the function that selects the position numbers of a theme
+
+    The spec is a list of position numbers such as 1-20,50 or sample:N for N
+    random positions of every theme. The function takes the number of
+    positions of the theme and returns the selected numbers in order.
+    """
+    if spec.startswith('sample:'):
+        size = int(spec.split(':')[1])
+        rng = random.Random(SAMPLE_SEED)
+        return lambda count: sorted(rng.sample(range(1, count + 1), min(size, count)))
+
+    numbers = sorted(set(parse_number_list(spec)))
+    return lambda count: [n for n in numbers if 1 <= n <= count]
+
+
+def get_epd_sts_id(pos):
+    """ Returns the sts id of the epd line without parsing its opcodes """
+    i = pos.find('id "')
+    if i < 0:
+        return ''
+    return pos[i+4:].split(' ', 1)[0]
+
+
+def load_epd(fname, themes=None, positionFilter=None):
+    """ Read the epd file once, returns a dict of sts id and its positions
+
+    Only the themes in the themes list and the positions selected by the
+    positionFilter from get_position_filter() are parsed, all if None.
+    """
+    # 1b1r4/3rkp2/p3p2p/4q3/P5P1/2RBP3/P1Q4P/1R3K2 b - - bm Ba7;\
+    # c0 "Ba7=10, Qf6+=3, a5=3, h5=5";\
+    # id "STS(v2.2) Open Files and Diagonals.001";\
+    # c7 "Ba7 Qf6+ a5 h5";
+    # c8 "10 3 3 5";\
+    # c9 "b8a7 e5f6 a6a5 h6h5";
+    lines = OrderedDict()
+    for idItem in STS_ID:
+        if themes is None or idItem in themes:
+            lines[idItem] = []
+
+    with open(fname) as f:
+        for line in f:
+            pos = line.strip()
+            if not pos:
+                continue
+            idv = get_epd_sts_id(pos)
+            if idv in lines:
+                lines[idv].append(pos)
+
+    positionIndex = load_position_index()
+    suite = OrderedDict()
+    for idItem, items in lines.items():
+        if positionFilter is None:
+            numbers = range(1, len(items) + 1)
+        else:
+            numbers = positionFilter(len(items))
+
+        suite[idItem] = []
+        for number in numbers:
+            pos = items[number-1]
+            a = pos.split(' ', 4)
+            fen = ' '.join(a[0:4]) + ' 0 1'
+            opcodes = parse_epd_opcodes(a[4] if len(a) > 4 else '')
+            entry = positionIndex.lookup(fen)
+
+            suite[idItem].append(EpdPosition(fen, idItem, opcodes['id'],
+                                             tuple(opcodes.get('c7', '').split()),
+                                             tuple(opcodes.get('c9', '').split()),
+                                             tuple(int(v) for v in opcodes.get('c8', '').split()),
+                                             pos, number,
+                                             None if entry is None else entry.sheet_index))
+
+    return suite
+
+
+def parse_info_line(eline):
+    """ Returns an InfoLine from a uci info line or None if it has nothing we use """
+    # Lines like "info depth 12 currmove e2e4 currmovenumber 1" and
+    # "info string ..." do not have time, nodes or score. The moves after
+    # pv are not read.
+    if eline.startswith('info string'):
+        return None
+    head = eline.split(' pv ', 1)[0]
+    if ' score ' not in head and ' time ' not in head and ' nodes ' not in head:
+        return None
+
+    a = head.split()
+    cp = mate = None
+    try:
+        depth = int(a[a.index('depth') + 1]) if 'depth' in a else None
+        etime = int(a[a.index('time') + 1]) if 'time' in a else None
+        nodes = int(a[a.index('nodes') + 1]) if 'nodes' in a else None
+        if 'score' in a:
+            i = a.index('score')
+            if a[i+1] == 'cp':
+                cp = int(a[i+2])
+            elif a[i+1] == 'mate':
+                mate = int(a[i+2])
+    except (ValueError, IndexError):
+        return None
+
+    if etime is None and nodes is None and cp is None and mate is None:
+        return None
+
+    return InfoLine(depth, etime, nodes, cp, mate)
+
+
+class LastInfo:
+    """ The last uci info lines with a cp score, mate score, time and nodes
+
+    Only these lines are used for the answer, so every line is only checked
+    for the words and the kept lines are parsed once after the best move.
+    """
+
+    def __init__(self):
+        self.cpLine = None
+        self.mateLine = None
+        self.timeLine = None
+        self.nodesLine = None
+
+    def add(self, eline):
+        """ Keep the info line if it has a score, time or nodes """
+        if ' score cp ' in eline:
+            self.cpLine = eline
+        elif ' score mate ' in eline:
+            self.mateLine = eline
+        if ' time ' in eline:
+            self.timeLine = eline
+        if ' nodes ' in eline:
+            self.nodesLine = eline
+
+    def get(self):
+        """ Returns the InfoLine of the cp score, the mate score, the time and the nodes """
+        lines = (self.cpLine, self.mateLine, self.timeLine, self.nodesLine)
+
+        # Usually the last score line also has the time and nodes
+        parsed = {None: None}
+        for eline in lines:
+            if eline not in parsed:
+                parsed[eline] = parse_info_line(eline)
+        return [parsed[eline] for eline in lines]
+
+
+async def send_position(session, proto, fen, uciLimit, nSt, nWBmps, minutePart, secondPart,
+                        resetPolicy):
+    """ Send the position and go commands, returns the time in sec to sync with the engine """
+    syncTime = 0.0
+
+    # Send commands
+    if proto:
+        await session.send("new")
+        await session.send("setboard " + fen)
+
+        if nSt:
+            if isinstance(nSt, int):
+                await session.send("st %d" %(nSt))
+            else:
+                await session.send("st %0.1f" %(float(nSt)))
+        else:
+            nInc = 0
+            nTime = 0
+            if secondPart == 0:
+                await session.send("level %d %d %d" %(nWBmps, minutePart, nInc))
+                nTime = minutePart*60*100  # centisec
+            else:
+                await session.send("level %d %d:%d %d" %(nWBmps, minutePart, secondPart, nInc))
+                nTime = ((minutePart*60) + secondPart) * 100  # centisec
+                
+            await session.send("time %d" %(nTime))
+        
+        await session.send("go")
+            
+    else:
+        # In pipeline mode the engine is not synced and its hash is not cleared
+        t1 = time.perf_counter()
+        if resetPolicy != RESET_PIPELINE:
+            await session.isready()
+
+        if resetPolicy == RESET_FULL:
+            await session.send("ucinewgame")
+        syncTime = time.perf_counter() - t1
+
+        await session.send("position fen " + fen)
+        await session.send("go " + uciLimit)
+
+    return syncTime
+
+
+async def read_answer(session, proto, searchTimeout):
+    """ Read the engine output until the best move
+
+    Returns an EngineAnswer and the time in sec spent on parsing the info
+    lines that are used. Raises EngineTimeout if there is no best move
+    after searchTimeout sec.
+    """
+    bm = None
+    deadline = get_deadline(searchTimeout)
+    lastInfo = LastInfo()
+
+    # PARSE ENGINE OUTPUT
+    while True:
+        eline = await session.readline(deadline)
+
+        if proto:
+            if "move" in eline and not "increment" in eline and not "moves_left" in eline\
+                               and not "time" in eline and not "TOURNAMENT" in eline and not "white" in eline\
+                               and not "black" in eline and not "#" in eline:
+                a = eline.split(" ")
+                bm = a[1]
+                bm = bm.strip()
+                break                        
+        else:                    
+            if eline.startswith('info'):
+                if not eline.startswith('info string'):
+                    lastInfo.add(eline)
+
+            elif eline.startswith('bestmove'):
+                a = eline.split(" ")
+                bm = a[1]
+                bm = bm.strip()
+                break  # bestmove is found
+
+    t1 = time.perf_counter()
+    cpInfo, mateInfo, timeInfo, nodesInfo = lastInfo.get()
+
+    etime = 0 if timeInfo is None or timeInfo.time is None else timeInfo.time
+    enodes = None if nodesInfo is None else nodesInfo.nodes
+    escore = emate = None
+    esdepth = emdepth = 0
+    if cpInfo is not None:
+        escore = cpInfo.cp
+        esdepth = cpInfo.depth or 0
+    if mateInfo is not None:
+        emate = mateInfo.mate
+        emdepth = mateInfo.depth or 0
+
+    # A mate score before a deeper cp score is not used
+    if esdepth > emdepth:
+        emate = None
+
+    parseTime = time.perf_counter() - t1
+
+    return EngineAnswer(bm, escore, emate, max(esdepth, emdepth), etime, enodes), parseTime
+
+
+async def search_position(session, fen, uciLimit, searchTimeout):
+    """ Send the position to the uci engine and returns an EngineAnswer """
+    await send_position(session, UCI, fen, uciLimit, 0, 0, 0, 0, RESET_FULL)
+    answer, _ = await read_answer(session, UCI, searchTimeout)
+    return answer
+
+
+def get_move_rank(bm, mvList):
+    """ Returns the index of the engine move in the solution moves or -1 """
+    for i, item in enumerate(mvList):
+        if bm == item:
+            return i
+    return -1
+
+
+def read_journal(fname):
+    """ Returns the header and the position records of a journal file """
+    header = None
+    records = []
+    with open(fname) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # A line may be incomplete if the run was killed
+                continue
+            if rec.get('type') == 'header':
+                header = rec
+            elif rec.get('type') == 'position':
+                records.append(rec)
+
+    return header, records
+
+
+def trim_journal(fname):
+    """ Remove the incomplete last line of a killed run so that new records start on a new line """
+    with open(fname, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+
+
+def get_fen_key(fen):
+    """ Returns the position key of the canonical fen, the move counters are not used """
+    return get_position_key(fen)
+
+
+def read_answers(fname):
+    """ Returns the header and a dict of fen key to engine move of a journal or stream file
+
+    The header is None if the file has no header, e.g. a stream file.
+    """
+    if fname.lower().endswith('.csv'):
+        header = None
+        with open(fname, newline='') as f:
+            records = [rec for rec in csv.DictReader(f) if rec.get('type') == 'position']
+    else:
+        header, records = read_journal(fname)
+
+    answers = {}
+    for rec in records:
+        if rec.get('move') and rec.get('fen'):
+            # The first answer is used, as in --resume
+            answers.setdefault(get_fen_key(rec['fen']), rec['move'])
+
+    return header, answers
+
+
+def rescore(inFile, suite, answerFn, maxPoints, optionSan, bCalculateRating):
+    """ Score the saved engine moves of answerFn against the positions of the epd file """
+    header, answers = read_answers(answerFn)
+    if header is not None:
+        optionSan = header.get('san', optionSan)
+
+    ResultData = []
+    missing = 0
+    for idItem, positions in suite.items():
+        pos_num, score, bmCnt = 0, 0, 0
+        for epdPos in positions:
+            bm = answers.get(get_fen_key(epdPos.fen))
+            if bm is None:
+                missing += 1
+                continue
+            mvList = epdPos.sanMoves if optionSan else epdPos.lanMoves
+            rank = get_move_rank(bm, mvList)
+            pos_num += 1
+            if rank >= 0:
+                score += epdPos.points[rank]
+            if rank == 0:
+                bmCnt += 1
+
+        scorePercent = 100*float(score)/(maxPoints*pos_num) if pos_num else 0.0
+        ResultData.append([idItem, pos_num, score, scorePercent, bmCnt])
+
+    numPositions = sum(len(positions) for positions in suite.values())
+    print('Rescore %s against %s' %(answerFn, inFile))
+    print('Positions with a saved answer: %d of %d' %(numPositions - missing, numPositions))
+
+    with open(resultFN, 'a') as resFO:
+        resFO.write('%s v%s, rescore\n' %(APP_NAME, __version__))
+        resFO.write('Answers: %s\n' %(answerFn))
+        if header is not None:
+            resFO.write('Answer limit: %s, options: %s, epd: %s\n' %(
+                header.get('limit'), header.get('options'), header.get('epd')))
+        resFO.write('Number of positions in %s: %d\n' %(inFile, numPositions))
+        resFO.write('Positions without a saved answer: %d\n' %(missing))
+        resFO.write('Max point: %d\n\n' %(maxPoints))
+        write_result_table(resFO, ResultData, maxPoints, bCalculateRating)
+        resFO.write('\n')
+
+    return ResultData
+
+
+async def measure_overhead(engineName, suite, hashv, threadsv, contemptOption):
+    """ Returns the average time in ms of a position beyond the movetime """
+    session, _ = await start_engine(engineName, UCI, hashv, threadsv, contemptOption, False, None)
+    overhead = []
+    try:
+        positions = [p for theme in suite.values() for p in theme[0:1]][0:WARMUP_POSITIONS]
+        for epdPos in positions:
+            t1 = time.perf_counter()
+            await search_position(session, epdPos.fen, 'movetime %d' % WARMUP_MOVETIME,
+                                  WARMUP_MOVETIME/1000.0 + SEARCH_TIMEOUT_MARGIN)
+            overhead.append(1000*(time.perf_counter() - t1) - WARMUP_MOVETIME)
+    finally:
+        await session.quit()
+
+    return max(0.0, sum(overhead)/len(overhead)) if overhead else 0.0
+
+
+async def measure_nps(engineName, suite, hashv, contemptOption):
+    """ Returns the engine id name, nodes and time in ms of the calibration searches """
+    session, engIdName = await start_engine(engineName, UCI, hashv, 1, contemptOption, False, None)
+    nodes = 0
+    etime = 0
+    try:
+        for positions in suite.values():
+            if not positions:
+                continue
+            answer = await search_position(session, positions[0].fen,
+                                           'movetime %d' % CALIBRATION_MOVETIME,
+                                           CALIBRATION_MOVETIME/1000.0 + SEARCH_TIMEOUT_MARGIN)
+            nodes += answer.nodes or 0
+            etime += answer.time
+    finally:
+        await session.quit()
+
+    return engIdName, nodes, etime
+
+
+def read_calibrations():
+    """ Returns the saved calibrations of CALIBRATION_FN """
+    if not os.path.isfile(CALIBRATION_FN):
+        return {}
+    with open(CALIBRATION_FN) as f:
+        return json.load(f)
+
+
+def save_calibration(key, calibration):
+    """ Save the calibration in CALIBRATION_FN, returns a copy marked as not cached """
+    data = read_calibrations()
+    data[key] = calibration
+    with open(CALIBRATION_FN, 'w') as f:
+        json.dump(data, f, indent=2)
+
+    calibration = dict(calibration)
+    calibration['cached'] = False
+    return calibration
+
+
+def get_calibration(engineName, suite, hashv, contemptOption, bRecalibrate):
+    """ Returns the nps of the engine in this computer
+
+    The engine searches the first position of every sts on one thread.
+    The result is saved in CALIBRATION_FN per computer, engine binary and
+    calibration positions.
+    """
+    fens = '|'.join(positions[0].fen for positions in suite.values() if positions)
+    key = '%s|%s|%s' % (platform.node(), get_file_hash(engineName),
+                        hashlib.sha1(fens.encode()).hexdigest())
+
+    data = read_calibrations()
+    if key in data and not bRecalibrate:
+        calibration = dict(data[key])
+        calibration['cached'] = True
+        return calibration
+
+    print('Measure the nps of %s ...' % engineName)
+    engIdName, nodes, etime = asyncio.run(measure_nps(engineName, suite, hashv, contemptOption))
+
+    if not nodes or not etime:
+        print('The reference engine %s did not report nodes and time' % engineName)
+        sys.exit(1)
+    nps = int(1000.0*nodes/etime)
+
+    return save_calibration(key, {'engine': engIdName, 'host': platform.node(), 'nps': nps,
+                                  'date': datetime.datetime.now().isoformat(timespec='seconds')})
+
+
+def get_bench_calibration(bRecalibrate):
+    """ Returns the time of the python bench in this computer, saved in CALIBRATION_FN """
+    key = '%s|bench' % platform.node()
+    data = read_calibrations()
+    if key in data and not bRecalibrate:
+        calibration = dict(data[key])
+        calibration['cached'] = True
+        return calibration
+
+    bench = timeit.timeit('"-".join(str(n) for n in range(100))', number=100000)
+    return save_calibration(key, {'bench': bench, 'host': platform.node(),
+                                  'date': datetime.datetime.now().isoformat(timespec='seconds')})
+
+
+def get_rating_time(refEngine, refNps, suite, hashv, contemptOption, bRecalibrate):
+    """ Returns the analysis time in ms of --getrating and the calibration
+
+    The reference engine is refEngine or REF_ENGINE from the PATH, refNps
+    is its nps in the reference computer, REF_NPS if it is None and the
+    engine is REF_ENGINE_NAME.
+    """
+    if refEngine is None:
+        refEngine = shutil.which(REF_ENGINE)
+        if refEngine is None and refNps is not None:
+            print('--refnps needs --refengine, %s is not found in the PATH' % REF_ENGINE)
+            sys.exit(2)
+
+    calibration = None
+    if refEngine is not None:
+        calibration = get_calibration(refEngine, suite, hashv, contemptOption, bRecalibrate)
+        if refNps is None and calibration['engine'] != REF_ENGINE_NAME:
+            print('The reference nps is for %s, not for %s, use --refnps' % (
+                REF_ENGINE_NAME, calibration['engine']))
+            print('The python bench is used')
+            calibration = None
+
+    if calibration is not None:
+        calibration['refnps'] = refNps or REF_NPS
+        analysisTime = RATING_ANALYSIS_TIME * float(calibration['refnps']) / calibration['nps']
+        print('Reference engine nps : %d' %(calibration['nps']))
+        print('Reference nps        : %d' %(calibration['refnps']))
+    else:
+        calibration = get_bench_calibration(bRecalibrate)
+        analysisTime = RATING_ANALYSIS_TIME * calibration['bench'] / BENCH_REF_TIME
+        print('Your bench : %0.6fs' %(calibration['bench']))
+        print('My bench   : %0.6fs' %(BENCH_REF_TIME))
+
+    # Slower computer gets more time
+    analysisTime = int(max(50, analysisTime))  # ms
+    calibration['movetime'] = analysisTime
+    print('Analysis Time to get CCRL 40/4 rating estimate : %dms' %(analysisTime))
+    return analysisTime, calibration
+
+
+def get_job(jobQueue):
+    """ Returns the next job or None if the queue is empty """
+    try:
+        return jobQueue.get_nowait()
+    except queue.Empty:
+        return None
+
+
+def add_theme_result(r, epdPos, move, optionSan, depth, nodes):
+    """ Add the points of the engine move to the theme result r, returns the rank and points
+
+    Used for the analyzed positions and for the positions of --resume.
+    """
+    mvList = epdPos.sanMoves if optionSan else epdPos.lanMoves
+    rank = get_move_rank(move, mvList)
+    points = epdPos.points[rank] if rank >= 0 else 0
+
+    # r = [pos_num, score, bmCnt, depthSum, nodesSum, scoreSqSum, pointsList]
+    r[0] += 1
+    r[1] += points
+    r[5] += points*points
+    r[6].append(points)
+    if rank == 0:
+        r[2] += 1
+    r[3] += depth
+    r[4] += nodes or 0
+    return rank, points
+
+
+def score_answer(job, answer, posTiming, themeResult, debug, logfnFO,
+                 maxPoints, optionSan, journalFO, stream):
+    """ Add the points of the engine move to the theme result and save the answer """
+    idItem, posIndex, epdPos = job
+    bm = answer.bestMove
+
+    # Save the epd moves, can be san or lan
+    pos = epdPos.epd
+
+    # Compare fen and engine move
+    r = themeResult[idItem]
+    rank, points = add_theme_result(r, epdPos, bm, optionSan, answer.depth, answer.nodes)
+    pos_num = r[0]
+
+    if rank == 0:
+        if debug:
+            logfnFO.write("Engine best move is correct!!\n")
+            logfnFO.write("Position points earned             : %d\n" %(points))
+            logfnFO.write("Total points for this theme so far : %d/%d\n\n" %(r[1], maxPoints*pos_num))
+    elif rank > 0:
+        if debug:
+            logfnFO.write("Engine best move is in alternative moves!\n")
+            logfnFO.write("Position points earned             : %d\n" %(points))
+            logfnFO.write("Total points for this theme so far : %d/%d\n\n" %(r[1], maxPoints*pos_num))
+    else:
+        if debug:
+            logfnFO.add_unsolved(pos)
+
+            logfnFO.write("Engine best move is not one of the solution moves??\n\n")
+            logfnFO.write("Total points for this theme so far : %d/%d\n\n" %(r[1], maxPoints*pos_num))
+
+    rec = {'type': 'position', 'sts': idItem, 'index': posIndex, 'sheet': epdPos.sheet,
+           'id': epdPos.name,
+           'fen': epdPos.fen, 'move': bm, 'rank': rank, 'points': points,
+           'score': answer.score, 'mate': answer.mate, 'depth': answer.depth,
+           'time': answer.time, 'nodes': answer.nodes}
+    if posTiming is not None:
+        rec['sync'] = round(1000*posTiming[0], 3)
+        rec['wall'] = round(1000*posTiming[1], 3)
+        rec['parse'] = round(1000*posTiming[3], 3)
+
+    # Save the answer so that the run can be resumed
+    if bm is not None:
+        journalFO.write(json.dumps(rec) + '\n')
+        journalFO.flush()
+
+    if stream is not None:
+        stream.write(rec)
+
+    if debug:
+        logfnFO.flush()
+
+
+async def engine_worker(session, restartEngine, proto, jobQueue, themeResult, uciLimit, nSt,
+                        nWBmps, minutePart, secondPart, debug, logfnFO, maxPoints,
+                        optionSan, cache, journalFO, stream, resetPolicy, timing,
+                        searchTimeout, maxRetries, failed, crashes, stopRule, budget,
+                        slotStats):
+    """ Take positions from the job queue and score the engine moves until the queue is empty
+
+    If the engine hangs or terminates it is restarted with restartEngine() and
+    the position is tried again, up to maxRetries times. Positions that are
+    not analyzed are added to failed, crashes counts the engine failures.
+    stopRule() is called after every scored position if it is not None.
+    The movetime comes from the budget if it is not None. slotStats is
+    [positions, nodes, engineTime] of the searches of this worker.
+    """
+
+    async def start_job(job):
+        """ Returns the cached answer or sends the position to the engine """
+        idItem, posIndex, epdPos = job
+
+        # Show console progress
+        print('Id: %s, Position: %d \r' %(idItem, posIndex)),
+
+        # Log
+        if debug:
+            logfnFO.write("Pos %d\n" %(posIndex))
+            logfnFO.write("%s\n\n" %(epdPos.epd))
+
+        answer = cache.get(epdPos.fen) if cache is not None else None
+        if answer is not None:
+            return answer, 0.0, 0.0
+
+        limit = uciLimit if budget is None else budget.get_uci_limit()
+        syncTime = await send_position(session, proto, epdPos.fen, limit, nSt, nWBmps,
+                                       minutePart, secondPart, resetPolicy)
+        return None, syncTime, time.perf_counter()
+
+    job = get_job(jobQueue)
+    started = None
+    retries = 0
+    try:
+        while job is not None:
+            try:
+                if started is None:
+                    started = await start_job(job)
+                answer, syncTime, goTime = started
+
+                posTiming = None
+                if answer is None:
+                    answer, parseTime = await read_answer(session, proto, searchTimeout)
+                    searchTime = time.perf_counter() - goTime
+                    if cache is not None:
+                        cache.put(job[2].fen, answer)
+                    posTiming = (syncTime, searchTime, answer.time/1000.0, parseTime)
+                    timing.append(posTiming)
+                    slotStats[0] += 1
+                    slotStats[1] += answer.nodes or 0
+                    slotStats[2] += answer.time
+                elif debug:
+                    logfnFO.write("Cached bestmove %s\n" %(answer.bestMove))
+                retries = 0
+
+                # In pipeline mode the engine searches the next position while this one is scored
+                current = job
+                job = get_job(jobQueue)
+                started = None
+                try:
+                    if job is not None and resetPolicy == RESET_PIPELINE:
+                        started = await start_job(job)
+                finally:
+                    score_answer(current, answer, posTiming, themeResult, debug, logfnFO,
+                                 maxPoints, optionSan, journalFO, stream)
+                    if stopRule is not None:
+                        stopRule()
+
+            except EngineError as err:
+                # Watchdog, the engine is hung or terminated
+                started = None
+                crashes['timeout' if isinstance(err, EngineTimeout) else 'terminated'] += 1
+                print('\n%s, position %s %d' %(err, job[0], job[1]))
+                if debug:
+                    logfnFO.write("%s, position %s %d\n" %(err, job[0], job[1]))
+                session.kill()
+                await session.quit()
+
+                if retries < maxRetries:
+                    retries += 1
+                else:
+                    # The position crashes the engine, continue with the next one
+                    failed.append(job)
+                    job = get_job(jobQueue)
+                    retries = 0
+                    if job is None:
+                        break
+
+                # Start a new engine with the same options
+                session, _ = await restartEngine()
+                crashes['restarts'] += 1
+                if session is None:
+                    failed.append(job)
+                    break
+
+    except EngineError as err:
+        # The engine cannot be restarted
+        print('\n%s' % err)
+        if debug:
+            logfnFO.write("%s\n" %(err))
+        failed.append(job)
+
+    finally:
+        if session is not None:
+            await session.quit()
+
+
+def get_sts_label(idItem):
+    """ Returns the column label of the sts id, e.g. STS1 """
+    return 'STS%d' %(STS_ID.index(idItem) + 1)
+
+
+def write_result_table(resFO, ResultData, maxPoints, bCalculateRating):
+    """ Write the result of every theme and of all themes """
+    # ResultData = ([idItem, pos_num, score, scorePercent, bmCnt])
+    totalPos = sum(item[1] for item in ResultData)
+    totalBm = sum(item[4] for item in ResultData)
+    totalScore = sum(item[2] for item in ResultData)
+    maxScore = maxPoints*totalPos
+
+    # One column per theme in the result and the ALL column
+    resFO.write('%8s' %('STS ID') + ''.join(' %6s' %(get_sts_label(item[0])) for item in ResultData) +
+                ' %6s\n' %('ALL'))
+    resFO.write('%8s' %('NumPos') + ''.join(' %6d' %(item[1]) for item in ResultData) +
+                ' %6d\n' %(totalPos))
+    resFO.write('%8s' %('BestCnt') + ''.join(' %6d' %(item[4]) for item in ResultData) +
+                ' %6d\n' %(totalBm))
+    resFO.write('%8s' %('Score') + ''.join(' %6d' %(item[2]) for item in ResultData) +
+                ' %6d\n' %(totalScore))
+
+    if maxScore:
+        resFO.write('%8s' %('Score(%)') + ''.join(' %6.1f' %(item[3]) for item in ResultData) +
+                    ' %6.1f\n' %(100*float(totalScore)/maxScore))
+    if bCalculateRating and totalPos:
+        sp = 100*float(totalScore)/maxScore
+        resFO.write('%8s' %('Rating') +
+                    ''.join(' %6.0f' %(RATING_SLOPE*item[3] + RATING_INTERCEPT) for item in ResultData) +
+                    ' %6.0f\n' %(RATING_SLOPE*sp + RATING_INTERCEPT))
+
+
+async def analyze_pos(inFile, engineName, hashv, threadsv, stime, debug, suite,
                 bCalculateRating, nRatingAnaTime, proto, sWBtc, nWBmps, nSt, optionSan,
-                contemptOption, maxPoints):
-    """ Analyze positions """
+                contemptOption, maxPoints, concurrency, bCache, bRefresh, cacheSize,
+                bResume, streamFn, nodesLimit, depthLimit, calibration, resetPolicy,
+                maxRetries, slots, precision, bootstrap, budget, bLogCompress):
+    """ Analyze positions, returns the engine id name and the result of every theme
+
+    The engine instances are started when a slot of the slots queue is free,
+    the slots can be shared by the runs of several engines. A slot is its
+    number and the cpus the instance is pinned to or None.
+    """
 
     # nSt is an integer by default
     
@@ -114,6 +1483,7 @@ def analyze_pos(inFile, engineName, hashv, threadsv, stime, debug, numberOfPosit
     newEng = engineName[0:-4]
     logfn = newEng + "_stslog.txt"
     logNotSolved = newEng + "_notSolved.epd"
+    journalFn = newEng + "_journal.jsonl"
 
     # simplify time if this is wb
     minutePart = 0
@@ -132,462 +1502,238 @@ def analyze_pos(inFile, engineName, hashv, threadsv, stime, debug, numberOfPosit
             else:
                 minutePart = int(sWBtc)
             
+    # Validate hash value
+    if hashv < 1:
+        hashv = 16
+    elif hashv > 16000:
+        hashv = 16000
+
+    # Validate num threads
+    if threadsv < 1:
+        threadsv = 1
+    elif threadsv > 16:
+        threadsv = 16
+
+    # Search limit of uci engines, nodes and depth do not depend on the hardware
+    if nodesLimit or depthLimit:
+        uciLimit = ''
+        if depthLimit:
+            uciLimit += 'depth %d ' % depthLimit
+        if nodesLimit:
+            uciLimit += 'nodes %d ' % nodesLimit
+        uciLimit = uciLimit.strip()
+    else:
+        uciLimit = 'movetime %d' % stime
+
+    # Validate number of engine instances
+    if concurrency < 1:
+        concurrency = 1
 
     # Delete these file because the mode is overwrite
+    logfnFO = None
     if debug:
         delete_file(logfn)
+        delete_file(logfn + '.gz')
         delete_file(logNotSolved)
-        logfnFO = open(logfn, 'w')
+        logfnFO = DebugLog(logfn, logNotSolved, bLogCompress)
     
-    # Run engine
-    p = subprocess.Popen(engineName, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True, bufsize=1)
-    print("Starting engine " + engineName + " ...")
-
-    if debug:
-        logfnFO.write("Starting engine " + engineName + " ...\n")  
-
-    waitTime = 30
-    if proto == WB:
-        if debug:
-            print('Set wait time to %ds' % waitTime)
-            logfnFO.write('Set wait time to %ds\n' % waitTime)
-        p.stdin.write("xboard\n")
-    else:
-        p.stdin.write("uci\n")
-        
-    if debug:
-        if proto == WB:
-            print('>> xboard')
-            logfnFO.write(">> xboard\n")
+    # Saved answers are only valid for the same engine, options and limit
+    if proto:
+        if nSt:
+            limit = 'st %s' % nSt
         else:
-            # print '>> uci'
-            logfnFO.write(">> uci\n")
-            
-    ENG_ID_NAME = "engine name"
-
-    # Parse winboard engine output
-    if proto == WB:
-        bSupportSetboard = False
-        wbt1 = time.perf_counter()
-        ENG_ID_NAME = engineName[:-4]
-        ENG_ID_NAME = ENG_ID_NAME.strip()
-        
-        p.stdin.write("protover 2\n")
-        if debug:
-            print('>> protover 2')
-            logfnFO.write(">> protover 2\n")
-
-        # Parse engine output        
-        for eline in iter(p.stdout.readline, ''):
-            eline = eline.strip()
-            
-            # Print in console
-            if debug:
-                print('<< %s' % eline)
-            
-            if debug:
-                logfnFO.write("<< " + eline + "\n")
-            if "done=0" in eline:
-                print('Receive done=0')
-                waitTime = waitTime*3
-                print('Increase wait time to %ds' % waitTime)             
-                if debug:
-                    logfnFO.write("Received done=0\n")
-                    logfnFO.write('Increase wait time to %ds\n' % waitTime)
-            if "setboard=1" in eline:
-                bSupportSetboard = True
-                if debug:
-                    print('Received setboard=1')
-                    logfnFO.write("Received setboard=1\n")
-            if "done=1" in eline:
-                if debug:
-                    print('Received done=1')
-                    print('Stop parsing engine init output')
-                    logfnFO.write('Received done=1\n')
-                    logfnFO.write('Stop parsing engine init output\n')
-                break             
-            # Check if we exceed wait time
-            wbt2 = time.perf_counter()
-            tdiff = (wbt2 - wbt1)
-            if tdiff > waitTime:             
-                if debug:
-                    print('Did not received done=1 after %ds' % waitTime)
-                    print('Stop parsing engine init output')
-                    with open(logfn, 'a') as f:
-                        f.write('Did not received done=1 after %ds\n' % waitTime)
-                        f.write('Stop parsing engine init output\n')
-                break
-
-        # Exit if winboard engine does not support setboard command
-        if not bSupportSetboard:
-            p.stdin.write("quit\n")
-            p.stdin.close()
-            p.communicate()
-
+            limit = 'level %d %d:%d %d' % (nWBmps, minutePart, secondPart, incPart)
+        options = ''
+    else:
+        limit = uciLimit
+        options = 'Hash=%d,Threads=%d,Contempt=%d' % (hashv, threadsv, contemptOption)
+    engineHash = get_file_hash(engineName)
+
+    # The movetime of a budget run changes, the answers are not saved
+    cache = None
+    if bCache and budget is None:
+        cache = ResultCache(CACHE_FN, engineHash, options, limit, resetPolicy, cacheSize,
+                            bRefresh)
+
+    # themeResult[idItem] = [pos_num, score, bmCnt, depthSum, nodesSum, scoreSqSum, pointsList]
+    themeResult = {}
+    for idItem in STS_ID:
+        themeResult[idItem] = [0, 0, 0, 0, 0, 0, []]
+
+    # timing = [(syncTime, searchTime, engineTime, parseTime)] of searched positions in sec
+    timing = []
+
+    # The journal has one line per analyzed position, the first line
+    # has the settings of the run.
+    journalHeader = {'type': 'header', 'engine': engineHash, 'options': options,
+                     'limit': limit, 'epd': inFile, 'maxpoint': maxPoints, 'san': optionSan}
+    done = set()
+    if bResume and os.path.isfile(journalFn):
+        header, records = read_journal(journalFn)
+        if header is not None and header != journalHeader:
+            print('The settings in %s are different, cannot resume' % journalFn)
+            if cache is not None:
+                cache.close()
             if debug:
-                with open(logfn, 'a') as f:
-                    f.write("setboard command is not supported\n")
-                    f.write("quit engine\n")
-
-            print('setboard command is not supported')
-            print('quit the engine')
+                logfnFO.close()
             return
 
-        p.stdin.write("post\n")
-        p.stdin.write("new\n")
-        p.stdin.write("hard\n")
-        p.stdin.write("easy\n")   
-        if debug:
-            with open(logfn, 'a') as f:
-                f.write(">> post\n")
-                f.write(">> new\n")
-                f.write(">> hard\n")
-                f.write(">> easy\n")        
-
-    else: # Uci
-        for eline in iter(p.stdout.readline, ''):
-            eline = eline.strip()
-            if debug:
-                # print '<< %s' % eline
-                logfnFO.write("<< " + eline + "\n")
-
-            if "id name" in eline:
-                ENG_ID_NAME = eline.strip()
-                ENG_ID_NAME = ENG_ID_NAME.split(' ')
-                ENG_ID_NAME = ' '.join(ENG_ID_NAME[2:])
-                ENG_ID_NAME = ENG_ID_NAME.strip()
-                print("id name: %s\n\n" %(ENG_ID_NAME))
-            if "uciok" in eline:
-                break
+        positions = {}
+        for idItem, items in suite.items():
+            for epdPos in items:
+                positions[(idItem, epdPos.number)] = epdPos
+
+        for rec in records:
+            key = (rec['sts'], rec['index'])
+            epdPos = positions.get(key)
+            if epdPos is None or epdPos.fen != rec['fen'] or key in done:
+                continue
+            done.add(key)
+
+            # Score again from the saved move
+            add_theme_result(themeResult[rec['sts']], epdPos, rec['move'], optionSan,
+                             rec['depth'], rec.get('nodes'))
+
+        print('Resume from %s, %d positions are already analyzed' % (journalFn, len(done)))
+        trim_journal(journalFn)
+        journalFO = open(journalFn, 'a')
+        if header is None:
+            journalFO.write(json.dumps(journalHeader) + '\n')
+    else:
+        journalFO = open(journalFn, 'w')
+        journalFO.write(json.dumps(journalHeader) + '\n')
+    journalFO.flush()
+
+    stream = None
+    if streamFn is not None:
+        stream = ResultStream(streamFn)
+
+    # Queue the positions to be analyzed, theme by theme
+    jobQueue = queue.Queue()
+    if precision or budget is not None:
+        # Random order that samples every theme so that the run can stop early
+        jobs = get_stratified_order(suite, SAMPLE_SEED)
+    else:
+        jobs = [(idItem, epdPos.number, epdPos) for idItem, positions in suite.items()
+                for epdPos in positions]
+    for job in jobs:
+        if job[0:2] not in done:
+            jobQueue.put(job)
 
-        # Validate hash value
-        if hashv < 1:
-            hashv = 16
-        elif hashv > 16000:
-            hashv = 16000
-        p.stdin.write("setoption name Hash value " + str(hashv) + "\n")
-        if debug:
-            logfnFO.write(">> setoption name Hash value " + str(hashv) + "\n")
+    if budget is not None:
+        budget.add_queue(jobQueue)
 
-        p.stdin.write("setoption name Contempt value " + str(contemptOption) + "\n")
-        if debug:
-            logfnFO.write(">> setoption name Contempt value " + str(contemptOption) + "\n")
+    themeSize = dict((idItem, len(positions)) for idItem, positions in suite.items())
+    earlyStop = []
 
-        # Validate num threads
-        if threadsv < 1:
-            threadsv = 1
-        elif threadsv > 16:
-            threadsv = 16
+    def check_precision():
+        """ Stop the run when the rating interval is within the precision """
+        if earlyStop:
+            return
+        interval = get_confidence_interval(themeResult, themeSize, maxPoints)
+        if interval is not None and RATING_SLOPE*interval[1] <= precision:
+            earlyStop.append(interval)
+            while get_job(jobQueue) is not None:
+                pass
 
-        # Set threads, cores and max cpus
-        p.stdin.write("setoption name Threads value " + str(threadsv) + "\n")
-        if debug:
-            logfnFO.write(">> setoption name Threads value " + str(threadsv) + "\n")
+    # An engine that does not send its move after the search limit and the
+    # margin is considered as hung
+    if proto:
+        if nSt:
+            searchTimeout = float(nSt) + SEARCH_TIMEOUT_MARGIN
+        else:
+            searchTimeout = minutePart*60 + secondPart + SEARCH_TIMEOUT_MARGIN
+    elif nodesLimit or depthLimit:
+        searchTimeout = SEARCH_TIMEOUT_NO_CLOCK
+    else:
+        searchTimeout = float(stime)/1000 + SEARCH_TIMEOUT_MARGIN
+
+    # Positions that are not analyzed because the engine failed
+    failed = []
+    crashes = {'timeout': 0, 'terminated': 0, 'restarts': 0}
+
+    engIdNames = []
+    runStart = []
+
+    # placement[slot] = (cpus, [positions, nodes, engineTime]) of the instances in the slot
+    placement = OrderedDict()
+
+    async def run_worker():
+        """ Run an engine instance when a slot is free until the job queue is empty """
+        slot, cpus = await slots.get()
+        try:
+            # Another instance has done the positions while this one waited
+            if engIdNames and jobQueue.empty():
+                return
+
+            # The log lines of the instances are mixed, every line has the instance number
+            workerLog = WorkerLog(logfnFO, slot + 1) if debug else None
+
+            def restart_engine():
+                return start_engine(engineName, proto, hashv, threadsv, contemptOption,
+                                    debug, workerLog, cpus)
+
+            if not runStart:
+                runStart.append(time.perf_counter())
+            slotStats = placement.setdefault(slot, (cpus, [0, 0, 0]))[1]
+            try:
+                session, engIdName = await restart_engine()
+            except EngineError as err:
+                print('\n%s' % err)
+                if debug:
+                    workerLog.write("%s\n" %(err))
+                return
+
+            engIdNames.append(engIdName)
+            if session is None:
+                # Winboard engine without setboard, no instance can analyze
+                engIdNames.append(None)
+                while get_job(jobQueue) is not None:
+                    pass
+                return
+
+            await engine_worker(session, restart_engine, proto, jobQueue, themeResult,
+                                uciLimit, nSt, nWBmps, minutePart, secondPart, debug,
+                                workerLog, maxPoints, optionSan, cache,
+                                journalFO, stream, resetPolicy, timing, searchTimeout,
+                                maxRetries, failed, crashes,
+                                check_precision if precision else None, budget,
+                                slotStats)
+        finally:
+            slots.put_nowait((slot, cpus))
 
-        p.stdin.write("setoption name Cores value " + str(threadsv) + "\n")
+    try:
+        await asyncio.gather(*[run_worker() for _ in range(concurrency)])
+    except BaseException:
+        # Interrupted, e.g. by Ctrl-C, keep the log of the positions done
         if debug:
-            logfnFO.write(">> setoption name Cores value " + str(threadsv) + "\n")
-
-        p.stdin.write("setoption name Max CPUs value " + str(threadsv) + "\n")
+            logfnFO.close()
+        raise
+    timeStart = runStart[0] if runStart else time.perf_counter()
+
+    if not engIdNames or None in engIdNames:
+        if stream is not None:
+            stream.close()
+        if cache is not None:
+            cache.close()
+        journalFO.close()
         if debug:
-            logfnFO.write(">> setoption name Max CPUs value " + str(threadsv) + "\n")
-            logfnFO.write("\n")
+            logfnFO.close()
+        return None
+    ENG_ID_NAME = engIdNames[0]
+
+    # Positions that crash the engine and those that are left when no
+    # engine can be restarted are not analyzed, these get no points
+    notAnalyzed = failed + [job for job in iter(lambda: get_job(jobQueue), None)]
+    for job in notAnalyzed:
+        score_answer(job, EngineAnswer(None, None, None, 0, 0, None), None, themeResult,
+                     debug, logfnFO, maxPoints, optionSan, journalFO, stream)
+    if notAnalyzed:
+        print('Warning, %d positions were not analyzed' % len(notAnalyzed))
 
     ResultData = []
-
-    timeStart = time.perf_counter()
-
-    for idItem in STS_ID:
-        pos_num = 0
-        score = 0
-        bmCnt = 0
-    
-        with open(inFile, "r") as inFO:
-            
-            # 1b1r4/3rkp2/p3p2p/4q3/P5P1/2RBP3/P1Q4P/1R3K2 b - - bm Ba7;\
-            # c0 "Ba7=10, Qf6+=3, a5=3, h5=5";\
-            # id "STS(v2.2) Open Files and Diagonals.001";\
-            # c7 "Ba7 Qf6+ a5 h5";
-            # c8 "10 3 3 5";\
-            # c9 "b8a7 e5f6 a6a5 h6h5";            
-            
-            for line in inFO:
-
-                scoreList = []
-                mvList = []
-                
-                etime = 0
-                escore = -32767
-                emate = 1000
-                esdepth = 0
-                emdepth = 0
-                fifty = 0
-                move_num = 1
-                
-                pos = line.strip()
-
-                idt = pos.split(' ')
-                i = idt.index("id")
-                idv = idt[i+1]
-                idv = idv.strip()
-                idv = idv[1:]
-                idv = idv.strip()
-
-                if idItem != idv:
-                    continue
-     
-                pos_num += 1
-                
-                a = pos.split(" ")
-                fen = " ".join(a[0:4])
-
-                fen = fen + " " + str(fifty) + " " + str(move_num)
-
-                # Show console progress
-                print('Id: %s, Position: %d \r' %(idItem, pos_num)),
-
-                # Get score in c8
-                if "c8" in pos:
-                    a = pos.split(' ')
-                    i = a.index("c8")
-                    c8Val = ""
-                    c8Val = ' '.join(a[i+1:])                    
-                    c8Val = c8Val.split(';')
-                    c8Val = c8Val[0]                  
-                    c8Val = c8Val[1:-1]  # Remove head " and tail "
-                    c8Val = c8Val.strip()
-                    i = c8Val.split(' ')                   
-                    for item in i:
-                        val = item.strip()
-                        scoreList.append(int(val))
-                    
-                # Save the epd moves, can be san or lan
-                if optionSan:
-                    if "c7" in pos:
-                        a = pos.split(' ')
-                        i = a.index("c7")
-                        c7Val = ""
-                        c7Val = ' '.join(a[i+1:])
-                        c7Val = c7Val.split(';')
-                        c7Val = c7Val[0]                    
-                        c7Val = c7Val[1:-1]  # Remove head " and tail "
-                        c7Val = c7Val.strip()                        
-                        i = c7Val.split(' ')
-                        for item in i:
-                            mv = item.strip()
-                            mvList.append(mv)                    
-                else:
-                    if "c9" in pos:
-                        a = pos.split(' ')
-                        i = a.index("c9")
-                        c9Val = ""
-                        c9Val = ' '.join(a[i+1:])
-                        c9Val = c9Val[1:-2]  # Remove head " and tails " and ;
-                        c9Val = c9Val.strip()                   
-                        i = c9Val.split(' ')
-                        for item in i:
-                            mv = item.strip()
-                            mvList.append(mv)                    
-
-                # Log
-                if debug:
-                    logfnFO.write("Pos %d\n" %(pos_num))
-                    logfnFO.write("%s\n\n" %(pos))
-
-                assert(emate == 1000)
-                assert(escore == -32767)
-                
-                # Send commands
-                if proto:
-                    p.stdin.write("new\n")                    
-                    p.stdin.write("setboard " + fen + "\n")
-                    if debug:
-                        logfnFO.write("%s >> new\n" %(datetime.datetime.now().isoformat()))
-                        logfnFO.write("%s >> setboard %s\n" %(datetime.datetime.now().isoformat(), fen))
-
-                    if nSt:
-                        if isinstance(nSt, int):
-                            p.stdin.write("st %d\n" %(nSt))
-                        else:
-                            p.stdin.write("st %0.1f\n" %(float(nSt)))                            
-                    else:
-                        nInc = 0
-                        nTime = 0
-                        if secondPart == 0:
-                            p.stdin.write("level %d %d %d\n" %(nWBmps, minutePart, nInc))
-                            nTime = minutePart*60*100  # centisec
-                        else:
-                            p.stdin.write("level %d %d:%d %d\n" %(nWBmps, minutePart, secondPart, nInc))
-                            nTime = ((minutePart*60) + secondPart) * 100  # centisec
-                            
-                        p.stdin.write("time %d\n" %(nTime))
-                    
-                    p.stdin.write("go\n")
-                    if debug:
-                        if nSt:
-                            if isinstance(nSt, int):
-                                logfnFO.write("%s >> st %d\n" %(datetime.datetime.now().isoformat(), int(nSt)))
-                            else:
-                                logfnFO.write("%s >> st %0.1f\n" %(datetime.datetime.now().isoformat(), float(nSt)))
-                        else:
-                            if secondPart == 0:
-                                logfnFO.write("%s >> level %d %d %d\n" %(datetime.datetime.now().isoformat(), nWBmps, minutePart, nInc))
-                            else:
-                                logfnFO.write("%s >> level %d %d:%d %d\n" %(datetime.datetime.now().isoformat(), nWBmps, minutePart, secondPart, nInc))
-                            
-                            logfnFO.write("%s >> time %d\n" %(datetime.datetime.now().isoformat(), nTime))
-
-                        
-                        logfnFO.write("%s >> go\n" %(datetime.datetime.now().isoformat()))
-                        
-                else:
-                    p.stdin.write("isready\n")
-                    if debug:
-                        logfnFO.write("%s >> isready\n" %(datetime.datetime.now().isoformat()))
-                                
-                    for rline in iter(p.stdout.readline, ''):
-                        rline = rline.strip()
-                        if debug:
-                            logfnFO.write('%s << %s\n' %(datetime.datetime.now().isoformat(), rline))
-                        
-                        if "readyok" in rline:
-                            break
-                        
-                    p.stdin.write("ucinewgame\n")
-                    if debug:
-                        logfnFO.write("%s >> ucinewgame\n" %(datetime.datetime.now().isoformat()))
-                        logfnFO.write("%s >> position fen %s\n" %(datetime.datetime.now().isoformat(), fen))
-
-                    p.stdin.write("position fen " + fen + "\n")                    
-                    p.stdin.write("go movetime " + str(stime) + "\n")
-                    
-                    if debug:
-                        logfnFO.write("%s >> go movetime %s\n" %(datetime.datetime.now().isoformat(), str(stime)))
-                        
-                # PARSE ENGINE OUTPUT
-                for eline in iter(p.stdout.readline, ''):
-
-                    eline = eline.strip()
-
-                    if proto:
-                        if debug:
-                            logfnFO.write("%s << %s\n" %(datetime.datetime.now().isoformat(), eline.strip()))
-                        if "move" in eline and not "increment" in eline and not "moves_left" in eline\
-                                           and not "time" in eline and not "TOURNAMENT" in eline and not "white" in eline\
-                                           and not "black" in eline and not "#" in eline:
-                            a = eline.strip()
-                            a = a.split(" ")
-                            bm = a[1]
-                            bm = bm.strip()
-
-                            # Compare fen and engine move
-                            bmFound = False
-                            
-                            for i, item in enumerate(mvList):
-                                if bm == item:
-                                    score += scoreList[i]
-                                    if i == 0:
-                                        bmCnt += 1
-                                        if debug:
-                                            logfnFO.write("Engine best move is correct!!\n")
-                                            logfnFO.write("Position points earned             : %d\n" %(scoreList[i]))
-                                            logfnFO.write("Total points for this theme so far : %d/%d\n\n" %(score, maxPoints*pos_num))
-                                    else:
-                                        if debug:
-                                            logfnFO.write("Engine best move is in alternative moves!\n")
-                                            logfnFO.write("Position points earned             : %d\n" %(scoreList[i]))
-                                            logfnFO.write("Total points for this theme so far : %d/%d\n\n" %(score, maxPoints*pos_num))
-                                    bmFound = True
-                                    break
-
-                            if not bmFound:
-                                if debug:
-                                    with open(logNotSolved, 'a') as wrongEpdFO:
-                                        wrongEpdFO.write(pos + "\n")
-                                        
-                                    logfnFO.write("Engine best move is not one of the solution moves??\n\n")
-                                    logfnFO.write("Total points for this theme so far : %d/%d\n\n" %(score, maxPoints*pos_num))
-                            
-                            break                        
-                    else:                    
-                        if debug:
-                            if "info" in eline or "bestmove" in eline:
-                                logfnFO.write("%s << %s\n" %(datetime.datetime.now().isoformat(), eline.strip()))                
-
-                        if "time" in eline and "info" in eline:
-                            a = eline.strip()
-                            #print('entered time: %s' %(a))
-                            a = a.split(" ")
-                            i = a.index("time")
-                            etime = a[i+1].strip()
-                            etime = int(etime)
-                            
-                        if "score cp" in eline:
-                            a = eline.strip().split(" ")
-                            i = a.index("cp")
-                            escore = a[i+1].strip()
-                            escore = int(escore)
-
-                            # Get the depth
-                            if "depth" in eline:
-                                a = eline.strip().split(" ")
-                                i = a.index("depth")
-                                esdepth = a[i+1].strip()
-                                esdepth = int(esdepth)
-                                
-                        elif "score mate" in eline:
-                            a = eline.strip().split(" ")
-                            i = a.index("mate")
-                            emate = a[i+1].strip()
-                            emate = int(emate)
-
-                            # Get the depth
-                            if "depth" in eline:
-                                a = eline.strip().split(" ")
-                                i = a.index("depth")
-                                emdepth = a[i+1].strip()
-                                emdepth = int(emdepth)
-                                    
-                        if "bestmove" in eline:
-                            a = eline.strip()
-                            a = a.split(" ")
-                            bm = a[1]
-                            bm = bm.strip()
-
-                            if(esdepth > emdepth):
-                                emate = 1000
-
-                            # Compare fen and engine move
-                            bmFound = False
-                            
-                            for i, item in enumerate(mvList):
-                                if bm == item:
-                                    score += scoreList[i]
-                                    if i == 0:
-                                        bmCnt += 1
-                                        if debug:
-                                            logfnFO.write("Engine best move is correct!!\n")
-                                            logfnFO.write("Position points earned             : %d\n" %(scoreList[i]))
-                                            logfnFO.write("Total points for this theme so far : %d/%d\n\n" %(score, maxPoints*pos_num))
-                                    else:
-                                        if debug:
-                                            logfnFO.write("Engine best move is in alternative moves!\n")
-                                            logfnFO.write("Position points earned             : %d\n" %(scoreList[i]))
-                                            logfnFO.write("Total points for this theme so far : %d/%d\n\n" %(score, maxPoints*pos_num))
-                                    bmFound = True
-                                    break
-
-                            if not bmFound:
-                                if debug:
-                                    with open(logNotSolved, 'a') as wrongEpdFO:
-                                        wrongEpdFO.write(pos + "\n")
-                                        
-                                    logfnFO.write("Engine best move is not one of the solution moves??\n\n")
-                                    logfnFO.write("Total points for this theme so far : %d/%d\n\n" %(score, maxPoints*pos_num))
-                                    
-                            break  # bestmove is found
+    for idItem in suite:
+        pos_num, score, bmCnt = themeResult[idItem][0:3]
 
         # Save the data after given id is done
         if pos_num:
@@ -600,36 +1746,54 @@ def analyze_pos(inFile, engineName, hashv, threadsv, stime, debug, numberOfPosit
 
         # Save the data
         ResultData.append([idItem, pos_num, score, scorePercent, bmCnt])
+
+    if stream is not None:
+        totalPos = sum(item[1] for item in ResultData)
+        totalScore = sum(item[2] for item in ResultData)
+        totalBm = sum(item[4] for item in ResultData)
+        summary = [[idItem, STS_TITLE[STS_ID.index(idItem)], pos_num, score, scorePercent, bmCnt]
+                   for idItem, pos_num, score, scorePercent, bmCnt in ResultData]
+        summary.append(['ALL', '', totalPos, totalScore,
+                        100*float(totalScore)/(maxPoints*totalPos) if totalPos else 0.0, totalBm])
+        for idItem, title, pos_num, score, scorePercent, bmCnt in summary:
+            rec = {'type': 'summary', 'sts': idItem, 'title': title, 'positions': pos_num,
+                   'points': score, 'maxpoints': maxPoints*pos_num,
+                   'percent': round(scorePercent, 2), 'bestcount': bmCnt}
+            if bCalculateRating:
+                rec['rating'] = round(RATING_SLOPE*scorePercent + RATING_INTERCEPT)
+            stream.write(rec)
+        stream.close()
                             
 
-    # Quit the engine
-    p.stdin.write("quit\n")
-    p.communicate()
+    if cache is not None:
+        cache.close()
+    journalFO.close()
 
     timeEnd = time.perf_counter()
 
     # Write summary of results
     with open(resultFN, 'a') as resFO:
-        totalScore = 0
-        totalPos = 0
-        r = ResultData
-        totalBm = 0
-
         # ResultData = ([idItem, pos_num, score, scorePercent, bmCnt])
-        for item in ResultData:
-            totalScore += item[2]
-            totalPos += item[1]
-            totalBm += item[4]
-            
-        maxScore = maxPoints*totalPos
+        totalScore = sum(item[2] for item in ResultData)
+        totalPos = sum(item[1] for item in ResultData)
 
-        numPositions = count_positions(inFile)
+        numPositions = sum(len(positions) for positions in suite.values())
 
         # Result matrix
         resFO.write('%s v%s\n' %(APP_NAME, __version__))
         resFO.write('Engine: %s\n' %(ENG_ID_NAME))
+        if concurrency > 1:
+            resFO.write('Concurrency: %d engines\n' %(concurrency))
         if proto == 0:  # UCI
-            resFO.write("Hash: %d, Threads: %d, time/pos: %0.3fs\n\n" %(hashv, threadsv, float(stime)/1000))
+            if nodesLimit or depthLimit:
+                resFO.write("Hash: %d, Threads: %d, limit/pos: %s\n" %(hashv, threadsv, uciLimit))
+            else:
+                resFO.write("Hash: %d, Threads: %d, time/pos: %0.3fs\n" %(hashv, threadsv, float(stime)/1000))
+            if totalPos:
+                depthSum = sum(v[3] for v in themeResult.values())
+                nodesSum = sum(v[4] for v in themeResult.values())
+                resFO.write("Average depth: %0.1f, average nodes: %0.0f\n" %(float(depthSum)/totalPos, float(nodesSum)/totalPos))
+            resFO.write("\n")
             resFO.write("Number of positions in %s: %d\n" %(inFile, numPositions))
             resFO.write("Max score = %d x %d = %d\n" %(numPositions, maxPoints, numPositions*maxPoints))
         else:
@@ -646,8 +1810,39 @@ def analyze_pos(inFile, engineName, hashv, threadsv, stime, debug, numberOfPosit
         m, s = divmod(seconds, 60)
         h, m = divmod(m, 60)
         resFO.write("Test duration: %02dh:%02dm:%02ds\n" % (h, m, s))
+        if proto == UCI and timing:
+            n = len(timing)
+            syncMs = 1000*sum(t[0] for t in timing)/n
+            searchMs = 1000*sum(t[1] for t in timing)/n
+            engineMs = 1000*sum(t[2] for t in timing)/n
+            resFO.write("Transition: %s, sync: %0.1fms/pos, go to bestmove: %0.1fms/pos, engine time: %0.1fms/pos\n" % (
+                resetPolicy, syncMs, searchMs, engineMs))
+            resFO.write("Protocol overhead: %0.1fms/pos\n" % (syncMs + searchMs - engineMs))
+
+            resFO.write("%-14s %8s %8s %8s\n" % ('Timing (ms)', 'p50', 'p95', 'max'))
+            for i, name in [(0, 'sync'), (1, 'go-bestmove'), (2, 'engine time'), (3, 'parse')]:
+                values = sorted(1000*t[i] for t in timing)
+                resFO.write("%-14s %8.1f %8.1f %8.1f\n" % (name, get_percentile(values, 50),
+                                                           get_percentile(values, 95), values[-1]))
+
+            # Engines that search longer than the movetime
+            if not (nodesLimit or depthLimit):
+                overrun = [1000*t[1] - stime for t in timing if 1000*t[1] > stime + MS_TIME_BUFFER]
+                if overrun:
+                    resFO.write("Warning: movetime overrun by more than %dms in %d positions, max overrun: %0.0fms\n" % (
+                        MS_TIME_BUFFER, len(overrun), max(overrun)))
+        if cache is not None:
+            resFO.write("Cached answers: %d, searched: %d\n" % (cache.hits, cache.misses))
+        if crashes['timeout'] or crashes['terminated']:
+            resFO.write("Engine failures: %d hung, %d terminated, restarts: %d\n" %(
+                crashes['timeout'], crashes['terminated'], crashes['restarts']))
+        if notAnalyzed:
+            resFO.write("Warning: %d positions were not analyzed, the engine failed\n" %(len(notAnalyzed)))
 
         at = 30  # 30ms added time
+        if proto == UCI and timing and not (nodesLimit or depthLimit):
+            # Measured time per position beyond the movetime
+            at = max(0.0, 1000*sum(t[0] + t[1] for t in timing)/len(timing) - stime)
         if proto:  # WB
             if isinstance(nSt, int):
                 pass
@@ -660,9 +1855,11 @@ def analyze_pos(inFile, engineName, hashv, threadsv, stime, debug, numberOfPosit
                 et = totalPos * ((minutePart*60) + secondPart)/nWBmps + totalPos*at/1000
         else:
             et = (totalPos * stime)/1000 + totalPos*at/1000
+        et = et/concurrency
         m, s = divmod(et, 60)
         h, m = divmod(m, 60)
-        resFO.write("Expected time to finish: %02dh:%02dm:%02ds\n" % (h, m, s))
+        if not (proto == 0 and (nodesLimit or depthLimit)):
+            resFO.write("Expected time to finish: %02dh:%02dm:%02ds\n" % (h, m, s))
         if proto:  # winboard
             if nSt:
                 if isinstance(nSt, int):
@@ -675,52 +1872,73 @@ def analyze_pos(inFile, engineName, hashv, threadsv, stime, debug, numberOfPosit
                 else:
                     resFO.write("Command: level %d %d %d\n" % (nWBmps, minutePart, incPart))                
 
+        if calibration is not None and 'bench' in calibration:
+            resFO.write("Calibration: bench %0.6fs%s, reference bench: %0.6fs, movetime: %dms\n" % (
+                calibration['bench'], ' (cached)' if calibration['cached'] else '',
+                BENCH_REF_TIME, calibration['movetime']))
+        elif calibration is not None:
+            resFO.write("Calibration: %s, nps: %d%s, reference nps: %d, movetime: %dms\n" % (
+                calibration['engine'], calibration['nps'],
+                ' (cached)' if calibration['cached'] else '',
+                calibration['refnps'], calibration['movetime']))
+
         if bCalculateRating:
-            slope = 44.523
-            intercept = -242.85
+            slope = RATING_SLOPE
+            intercept = RATING_INTERCEPT
             if totalPos:
                 sp = 100*float(totalScore)/(maxPoints*totalPos)
                 Rating = slope*sp + intercept
                 resFO.write('STS rating: %0.0f\n' %(Rating))
+
+        if any(cpus is not None for cpus, _ in placement.values()):
+            # Engine instances pinned with --affinity, nps of the searches per cpu set
+            resFO.write("Placement: %d threads per instance\n" %(threadsv))
+            for slot, (cpus, (n, nodes, etime)) in sorted(placement.items()):
+                resFO.write("  instance %d, cpus %s: %d positions, %0.0f nps\n" %(
+                    slot + 1, format_cpu_list(cpus), n, 1000.0*nodes/etime if etime else 0))
+
+        if budget is not None:
+            h, m = divmod(budget.seconds//60, 60)
+            resFO.write("Budget: %02d:%02d, warm-up overhead: %0.1fms/pos, concurrency: %d, planned movetime: %dms\n" %(
+                h, m, budget.overhead, budget.concurrency, budget.movetime))
+            resFO.write("Budget movetime used: %s-%sms, positions dropped to fit: %d\n" %(
+                budget.minUsed, budget.maxUsed, budget.trimmed))
+
+        if precision:
+            interval = get_confidence_interval(themeResult, themeSize, maxPoints)
+            resFO.write("Precision: +/-%0.1f rating, %s after %d of %d positions\n" %(
+                precision, 'stopped' if earlyStop else 'not reached', totalPos, numPositions))
+            if interval is not None:
+                sp, hw = interval
+                resFO.write("Score: %0.2f%% +/- %0.2f, rating: %0.0f +/- %0.1f (95%% interval)\n" %(
+                    sp, hw, RATING_SLOPE*sp + RATING_INTERCEPT, RATING_SLOPE*hw))
                 
         resFO.write('\n')  
                 
-        resFO.write('%8s %6s %6s %6s %6s %6s %6s %6s %6s %6s %6s %6s %6s %6s %6s %6s %6s\n' %('STS ID', 'STS1', 'STS2', 'STS3', 'STS4', 'STS5',\
-                                                                                                         'STS6', 'STS7', 'STS8', 'STS9', 'STS10', 'STS11',\
-                                                                                                         'STS12', 'STS13', 'STS14', 'STS15', 'ALL'))
-        
-        resFO.write('%8s %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d\n' %('NumPos', r[0][1], r[1][1], r[2][1], r[3][1], r[4][1],\
-                                                                                                         r[5][1], r[6][1], r[7][1], r[8][1],r[9][1], r[10][1],\
-                                                                                                         r[11][1], r[12][1], r[13][1], r[14][1],\
-                                                                                                               totalPos))
-
-        resFO.write('%8s %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d\n' %('BestCnt', r[0][4], r[1][4], r[2][4], r[3][4], r[4][4],\
-                                                                                                         r[5][4], r[6][4], r[7][4], r[8][4],r[9][4], r[10][4],\
-                                                                                                         r[11][4], r[12][4], r[13][4], r[14][4],\
-                                                                                                               totalBm))
-        
-        resFO.write('%8s %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d %6d\n' %('Score', r[0][2], r[1][2], r[2][2], r[3][2], r[4][2],\
-                                                                                                         r[5][2], r[6][2], r[7][2], r[8][2],r[9][2], r[10][2],\
-                                                                                                         r[11][2], r[12][2], r[13][2], r[14][2], totalScore))
-        
-        if maxScore:
-            resFO.write('%8s %6.1f %6.1f %6.1f %6.1f %6.1f %6.1f %6.1f %6.1f %6.1f %6.1f %6.1f %6.1f %6.1f %6.1f %6.1f %6.1f\n' %('Score(%)', r[0][3], r[1][3], r[2][3], r[3][3], r[4][3],\
-                                                                                                         r[5][3], r[6][3], r[7][3], r[8][3],r[9][3], r[10][3],\
-                                                                                                         r[11][3], r[12][3], r[13][3], r[14][3],\
-                                                                                                               100*float(totalScore)/maxScore))
-        if bCalculateRating:
-            sp = 100*float(totalScore)/(maxPoints*totalPos)
-            Rating = slope*sp + intercept
-            resFO.write('%8s %6.0f %6.0f %6.0f %6.0f %6.0f %6.0f %6.0f %6.0f %6.0f %6.0f %6.0f %6.0f %6.0f %6.0f %6.0f %6.0f\n' %('Rating', slope*r[0][3]+intercept, slope*r[1][3]+intercept,\
-                                                                                                                                 slope*r[2][3]+intercept, slope*r[3][3]+intercept, slope*r[4][3]+intercept,\
-                                                                                                                                 slope*r[5][3]+intercept, slope*r[6][3]+intercept, slope*r[7][3]+intercept,\
-                                                                                                                                 slope*r[8][3]+intercept,slope*r[9][3]+intercept,slope*r[10][3]+intercept,\
-                                                                                                                                 slope*r[11][3]+intercept, slope*r[12][3]+intercept, slope*r[13][3]+intercept,\
-                                                                                                                                 slope*r[14][3]+intercept,Rating))
+        write_result_table(resFO, ResultData, maxPoints, bCalculateRating)
+
+        if bootstrap and totalPos:
+            # Confidence intervals from resampling the points of the positions
+            intervals, overall = bootstrap_scores([themeResult[idItem][6] for idItem in suite],
+                                                  maxPoints, bootstrap)
+            resFO.write('\n95%% bootstrap interval, %d resamples\n' %(bootstrap))
+            rows = [('Low(%)', 0, 1.0, 0.0, '%6.1f'), ('High(%)', 1, 1.0, 0.0, '%6.1f')]
+            if bCalculateRating:
+                rows += [('RLow', 0, RATING_SLOPE, RATING_INTERCEPT, '%6.0f'),
+                         ('RHigh', 1, RATING_SLOPE, RATING_INTERCEPT, '%6.0f')]
+            for name, i, a, b, fmt in rows:
+                resFO.write('%8s' %(name))
+                for interval in intervals + [overall]:
+                    if interval is None:
+                        resFO.write(' %6s' %('-'))
+                    else:
+                        resFO.write(' ' + fmt %(a*interval[i] + b))
+                resFO.write('\n')
 
         resFO.write('\n:: STS ID and Titles ::\n')
-        for i, n in enumerate(STS_TITLE):
-            resFO.write('STS %02d: %s\n' % (i+1, n))
+        for item in ResultData:
+            idNum = STS_ID.index(item[0]) + 1
+            resFO.write('STS %02d: %s\n' % (idNum, STS_TITLE[idNum-1]))
 
         resFO.write('\n') 
 
@@ -753,6 +1971,63 @@ def analyze_pos(inFile, engineName, hashv, threadsv, stime, debug, numberOfPosit
     if debug:
         logfnFO.write("Test duration: %0.1fs\n" %(float(timeEnd - timeStart)))
         logfnFO.close()
+
+    return ENG_ID_NAME, ResultData
+
+
+def get_engine_labels(engineList):
+    """ Returns a unique short name of every engine
+
+    The name is the filename of the engine, with its number in the list
+    if other engines have the same filename, e.g. build1/sf and build2/sf
+    are sf_1 and sf_2.
+    """
+    names = [os.path.splitext(os.path.basename(e))[0] for e in engineList]
+    return [n if names.count(n) == 1 else '%s_%d' % (n, i+1) for i, n in enumerate(names)]
+
+
+def get_engine_stream_fn(streamFn, engineLabel):
+    """ Returns the stream filename of one of the compared engines """
+    root, ext = os.path.splitext(streamFn)
+    return '%s_%s%s' % (root, engineLabel, ext)
+
+
+def write_comparison(inFile, engineList, results, maxPoints):
+    """ Append the score percent and rating estimate of every engine to the result file """
+    labels = get_engine_labels(engineList)
+    names = [label if r is None else r[0] for label, r in zip(labels, results)]
+
+    # Builds of the same engine can have the same id name
+    if len(set(names)) < len(names):
+        names = labels
+    width = max(len(n) for n in names + ['Engine'])
+
+    with open(resultFN, 'a') as resFO:
+        resFO.write('%s v%s, engine comparison\n' %(APP_NAME, __version__))
+        resFO.write('Positions: %s\n\n' %(inFile))
+
+        resFO.write('%-*s' %(width, 'Engine'))
+        themes = next(r[1] for r in results + [(None, [])] if r is not None)
+        for item in themes:
+            resFO.write(' %6s' %(get_sts_label(item[0])))
+        resFO.write(' %6s %6s\n' %('ALL', 'Rating'))
+
+        for name, result in zip(names, results):
+            resFO.write('%-*s' %(width, name))
+            if result is None:
+                resFO.write(' failed\n')
+                continue
+
+            # ResultData = ([idItem, pos_num, score, scorePercent, bmCnt])
+            ResultData = result[1]
+            for item in ResultData:
+                resFO.write(' %6.1f' %(item[3]))
+            totalPos = sum(item[1] for item in ResultData)
+            totalScore = sum(item[2] for item in ResultData)
+            sp = 100*float(totalScore)/(maxPoints*totalPos) if totalPos else 0.0
+            resFO.write(' %6.1f %6.0f\n' %(sp, RATING_SLOPE*sp + RATING_INTERCEPT))
+
+        resFO.write('\n')
                             
 
 def main(argv):
@@ -774,12 +2049,41 @@ def main(argv):
     bSan = False
     contempt = 0
     maxpoint = 10
+    concurrency = 1
+    bCache = True
+    bRefresh = False
+    cacheSize = CACHE_MAX_ENTRIES
+    bResume = False
+    streamFn = None
+    nNodes = 0
+    nDepth = 0
+    sRefEngine = None
+    nRefNps = None
+    bRecalibrate = False
+    resetPolicy = RESET_FULL
+    nRetries = MAX_RETRIES
+    engineList = []
+    fPrecision = 0.0
+    sRescore = None
+    sBudget = None
+    sAffinity = None
+    bLogCompress = False
+    themes = None
+    positionFilter = None
+    bConcurrency = False
+    nBootstrap = 0
 
     try:
         opts, args = getopt.getopt(argv, "f:e:h:t:", ["file=", "engine=", "hash=", "threads=",
                                                       "movetime=", "log", 'getrating', 'proto=',
                                                       'tc=', 'mps=', 'st=', 'san', 'contempt=',
-                                                      'maxpoint='])
+                                                      'maxpoint=', 'concurrency=', 'no-cache',
+                                                      'refresh', 'cache-size=', 'resume', 'stream=',
+                                                      'nodes=', 'depth=', 'refengine=', 'refnps=',
+                                                      'recalibrate', 'reset=', 'retries=', 'engines=', 'precision=',
+                                                      'bootstrap=', 'rescore=', 'budget=',
+                                                      'affinity=', 'log-gzip', 'themes=',
+                                                      'positions='])
     except getopt.GetoptError as err:
         print(str(err))
         usage()
@@ -787,6 +2091,9 @@ def main(argv):
     for opt, arg in opts:
         if opt in ("--log"):
             bLog = True
+        elif opt in ("--log-gzip"):
+            bLog = True
+            bLogCompress = True
         elif opt in ("-f", "--file"):
             sFile = arg
         elif opt in ("-e", "--engine"):
@@ -815,9 +2122,87 @@ def main(argv):
             contempt = int(arg)
         elif opt in ("--maxpoint"):
             maxpoint = int(arg)
+        elif opt in ("--concurrency"):
+            concurrency = int(arg)
+            bConcurrency = True
+        elif opt in ("--no-cache"):
+            bCache = False
+        elif opt in ("--refresh"):
+            bRefresh = True
+        elif opt in ("--cache-size"):
+            cacheSize = int(arg)
+        elif opt in ("--resume"):
+            bResume = True
+        elif opt in ("--stream"):
+            streamFn = arg
+        elif opt in ("--nodes"):
+            nNodes = int(arg)
+        elif opt in ("--depth"):
+            nDepth = int(arg)
+        elif opt in ("--refengine"):
+            sRefEngine = arg
+        elif opt in ("--refnps"):
+            nRefNps = int(arg)
+        elif opt in ("--recalibrate"):
+            bRecalibrate = True
+        elif opt in ("--reset"):
+            resetPolicy = arg
+            if resetPolicy not in (RESET_FULL, RESET_HASH, RESET_PIPELINE):
+                print('reset %s is not supported, use full, hash or pipeline' % resetPolicy)
+                sys.exit(2)
+        elif opt in ("--retries"):
+            nRetries = int(arg)
+        elif opt in ("--bootstrap"):
+            nBootstrap = int(arg)
+            try:
+                load_numpy()
+            except ImportError as err:
+                print(str(err))
+                sys.exit(2)
+        elif opt in ("--themes"):
+            try:
+                themes = [STS_ID[n-1] for n in parse_number_list(arg) if 1 <= n <= len(STS_ID)]
+            except ValueError:
+                themes = []
+            if not themes:
+                print('themes %s is not valid, use theme numbers such as 1,5,12 or 1-3' % arg)
+                sys.exit(2)
+        elif opt in ("--positions"):
+            try:
+                positionFilter = get_position_filter(arg)
+            except ValueError:
+                print('positions %s is not valid, use position numbers such as 1-20,50 or sample:N' % arg)
+                sys.exit(2)
+        elif opt in ("--affinity"):
+            sAffinity = arg
+            if sAffinity not in (AFFINITY_CORE, AFFINITY_NUMA):
+                print('affinity %s is not supported, use core or numa' % sAffinity)
+                sys.exit(2)
+            if not hasattr(os, 'sched_setaffinity'):
+                print('affinity is not supported in this platform')
+                sys.exit(2)
+        elif opt in ("--budget"):
+            sBudget = arg
+        elif opt in ("--rescore"):
+            sRescore = arg
+        elif opt in ("--precision"):
+            fPrecision = float(arg)
+        elif opt in ("--engines"):
+            engineList = [e.strip() for e in arg.split(',') if e.strip()]
          
     # Validate engine, time, depth and file
-    if sEngine == None:
+    if sEngine is None and engineList:
+        sEngine = engineList[0]
+    if not engineList and sEngine is not None:
+        engineList = [sEngine]
+
+    if sRescore is not None:
+        # Score saved answers, the engine is not needed
+        if sFile is None or not os.path.isfile(sFile) or not os.path.isfile(sRescore):
+            print('epd file and answer file are needed to rescore')
+            sys.exit(1)
+        rescore(sFile, load_epd(sFile, themes, positionFilter), sRescore, maxpoint, bSan, bRate)
+    elif sEngine == None:
         print("Engine was not defined??\n")
         usage()
         input("\nPress enter key to exit")
@@ -827,19 +2212,22 @@ def main(argv):
         input("\nPress enter key to exit")
     else:
         # Verify engine exists
-        if sProto == 'uci' and not os.path.isfile(sEngine):
-            print('engine %s is missing' % sEngine)
-            input("Press enter key to exit")
-            sys.exit(1)
+        for e in engineList:
+            if sProto == 'uci' and not os.path.isfile(e):
+                print('engine %s is missing' % e)
+                input("Press enter key to exit")
+                sys.exit(1)
         # Verify if file exists
         if not os.path.isfile(sFile):
             print('test file %s is missing' % sFile)
             input("Press enter key to exit")
             sys.exit(1) 
-        print("\nEngine: %s" %(sEngine))
+        print("\nEngine: %s" %(', '.join(engineList)))
         if protocol == 0:
             print("Hash: %d, Threads: %d, MoveTime: %0.1fs" %(nHash, nThreads, float(nMoveTime)/1000))
-        numberOfPositions = count_positions(sFile)
+        timeBudgetStart = time.perf_counter()
+        suite = load_epd(sFile, themes, positionFilter)
+        numberOfPositions = sum(len(positions) for positions in suite.values())
         print("Number of positions in %s: %d\n" %(sFile, numberOfPositions))
 
         if sProto == 'uci':
@@ -849,25 +2237,69 @@ def main(argv):
             if nMoveTime < 1000:
                 nMoveTime = 1000
 
+        # The analysis time of --getrating measures this computer, the same
+        # for every engine so that their ratings can be compared
         analysisTime = 50
+        calibration = None
+        if bRate and protocol == WB:
+            bRate = False
         if bRate:
-            myTime = 2.5534  # sec in intel i7-2600k
-            yourTime = timeit.timeit('"-".join(str(n) for n in range(100))', number=100000)
-            print('Your bench : %0.6fs' %(yourTime))
-            print('My bench   : %0.6fs' %(myTime))
-
-            if protocol == WB:
-                bRate = False
-            else:                
-                analysisTime = 200 * yourTime/myTime
-                if analysisTime < 50:
-                    analysisTime = 50  # ms
-                print('Analysis Time to get CCRL 40/4 rating estimate : %0.0fms' %(analysisTime))
-                analysisTime = int(analysisTime)
-
-        analyze_pos(sFile, sEngine, nHash, nThreads, nMoveTime, bLog,
-                    numberOfPositions, bRate, analysisTime, protocol,
-                    stc, nmps, nSt, bSan, contempt, maxpoint)
+            # Calibrate on the positions of all themes, the same with --themes and --positions
+            analysisTime, calibration = get_rating_time(sRefEngine, nRefNps, load_epd(sFile),
+                                                        nHash, contempt, bRecalibrate)
+
+        budget = None
+        if sBudget is not None:
+            if protocol == WB or bRate or nNodes or nDepth:
+                print('--budget is only for uci engines without --getrating, --nodes and --depth')
+                sys.exit(2)
+            try:
+                h, m = sBudget.split(':')
+                budget = TimeBudget(3600*int(h) + 60*int(m), timeBudgetStart)
+            except ValueError:
+                print('budget %s is not in HH:MM format' % sBudget)
+                sys.exit(2)
+
+            # Measure the time per position beyond the movetime
+            overhead = asyncio.run(measure_overhead(engineList[0], suite, nHash, nThreads, contempt))
+
+            # Use all cores if the concurrency is not given
+            if not bConcurrency:
+                concurrency = max(1, (os.cpu_count() or 1)//max(1, nThreads))
+
+            nMoveTime = budget.plan(numberOfPositions*len(engineList), overhead, concurrency)
+            print('Budget: %s, overhead: %0.1fms/pos, concurrency: %d, movetime: %dms' %(
+                sBudget, overhead, concurrency, nMoveTime))
+
+        # Cpus of every engine instance, --getrating runs the engines with 1 thread
+        coreSets = [None]*max(1, concurrency)
+        if sAffinity is not None:
+            engineThreads = 1 if bRate else max(1, min(16, nThreads))
+            coreSets = get_core_sets(max(1, concurrency), engineThreads, sAffinity)
+            print('Affinity: %s' %(' '.join(format_cpu_list(cpus) for cpus in coreSets)))
+
+        async def run_all():
+            """ Analyze the positions with every engine, the engines share the worker slots """
+            slots = asyncio.Queue()
+            for slot, cpus in enumerate(coreSets):
+                slots.put_nowait((slot, cpus))
+            runs = []
+            for e, label in zip(engineList, get_engine_labels(engineList)):
+                engineStreamFn = streamFn
+                if streamFn is not None and len(engineList) > 1:
+                    engineStreamFn = get_engine_stream_fn(streamFn, label)
+                runs.append(analyze_pos(sFile, e, nHash, nThreads, nMoveTime, bLog,
+                                        suite, bRate, analysisTime, protocol,
+                                        stc, nmps, nSt, bSan, contempt, maxpoint, concurrency,
+                                        bCache, bRefresh, cacheSize, bResume, engineStreamFn,
+                                        nNodes, nDepth, calibration, resetPolicy, nRetries,
+                                        slots, fPrecision, nBootstrap, budget,
+                                        bLogCompress))
+            return await asyncio.gather(*runs)
+
+        results = asyncio.run(run_all())
+        if len(engineList) > 1:
+            write_comparison(sFile, engineList, results, maxpoint)
 
         print('\nDone!!')
         input("Press enter key to exit")   
@@ -0,0 +1,94 @@
+"""Bootstrap confidence intervals of STS scores.
+
+Used by sts_rating.py --bootstrap and tools/compare_journals.py. The
+positions of every theme are resampled with replacement, all resamples
+of a theme at once with NumPy. The overall score is the mean of the
+themes weighted by their number of positions.
+
+Requirements:
+  pip install numpy
+"""
+
+
+BOOTSTRAP_SEED = 1
+CONFIDENCE = 0.95
+
+
+def load_numpy():
+    """Returns the numpy module, it is only needed for the bootstrap."""
+    try:
+        import numpy as np
+    except ImportError as err:
+        raise ImportError('the bootstrap needs numpy, pip install numpy') from err
+    return np
+
+
+def resample_means(np, rng, values, resamples):
+    """Returns the means of resamples of values, an array of shape (resamples,)."""
+    n = len(values)
+    idx = rng.integers(0, n, size=(resamples, n), dtype=np.int32)
+    return values[idx].mean(axis=1)
+
+
+def bootstrap_scores(themePoints, maxPoints, resamples, seed=BOOTSTRAP_SEED):
+    """Returns the confidence intervals of the score percent of every theme and of all.
+
+    Args:
+      themePoints: List of per position points, one list per theme.
+      maxPoints: The max points of a position.
+      resamples: Number of bootstrap resamples.
+
+    Returns:
+      A list with a (low, high) score percent per theme, None for a theme
+      without positions, and the (low, high) of all themes.
+    """
+    np = load_numpy()
+    rng = np.random.default_rng(seed)
+    total = sum(len(p) for p in themePoints)
+    lo, hi = 50*(1 - CONFIDENCE), 50*(1 + CONFIDENCE)
+
+    intervals = []
+    overall = np.zeros(resamples)
+    for points in themePoints:
+        if not points:
+            intervals.append(None)
+            continue
+        pct = 100.0/maxPoints*np.asarray(points, dtype=np.float64)
+        means = resample_means(np, rng, pct, resamples)
+        overall += len(points)/total*means
+        intervals.append(tuple(float(v) for v in np.percentile(means, [lo, hi])))
+
+    if not total:
+        return intervals, None
+    return intervals, tuple(float(v) for v in np.percentile(overall, [lo, hi]))
+
+
+def bootstrap_paired(themePointsA, themePointsB, maxPoints, resamples, seed=BOOTSTRAP_SEED):
+    """Returns the score percent difference of A - B with its confidence interval.
+
+    The points of the two runs must be for the same positions in the same
+    order. Both runs are resampled with the same positions, so the
+    differences of the positions are resampled.
+
+    Returns:
+      The difference, the (low, high) of the difference and the fraction
+      of resamples where A is better.
+    """
+    np = load_numpy()
+    rng = np.random.default_rng(seed)
+    total = sum(len(p) for p in themePointsA)
+    lo, hi = 50*(1 - CONFIDENCE), 50*(1 + CONFIDENCE)
+
+    diff = np.zeros(resamples)
+    observed = 0.0
+    for pointsA, pointsB in zip(themePointsA, themePointsB):
+        if not pointsA:
+            continue
+        pct = 100.0/maxPoints*(np.asarray(pointsA, dtype=np.float64) -
+                               np.asarray(pointsB, dtype=np.float64))
+        w = len(pointsA)/total
+        diff += w*resample_means(np, rng, pct, resamples)
+        observed += w*pct.mean()
+
+    return (float(observed), tuple(float(v) for v in np.percentile(diff, [lo, hi])),
+            float((diff > 0).mean()))
@@ -0,0 +1,229 @@
+"""Keep the analysis of all positions in one sqlite file.
+
+The csv files of analyze.py have about 10 rows each and repeat the epd
+on every row. The store has a row per position with an integer key, a
+row per analysis (engine, user and depth) and a row per multipv line.
+The lines view has all the columns of the csv files plus the index,
+user and file.
+
+Usage:
+  python analysis_store.py import ../analysis --store analysis.db
+  python analysis_store.py query --store analysis.db --depth 32 --engine "Stockfish 15"
+"""
+
+
+__version__ = '0.1.0'
+
+
+import argparse
+import csv
+import logging
+import os
+import re
+import sqlite3
+import sys
+
+
+STORE_FN = 'analysis.db'
+CSV_NAME_RE = re.compile(r'^index_(\w+?)_d(\d+)_(.*)\.csv$')
+QUERY_FIELDS = ['index', 'epd', 'move', 'eval', 'depth', 'pv', 'engine', 'user', 'file']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS positions (
+  id INTEGER PRIMARY KEY,
+  epd TEXT NOT NULL UNIQUE,
+  sheet_index INTEGER);
+CREATE TABLE IF NOT EXISTS analyses (
+  id INTEGER PRIMARY KEY,
+  position_id INTEGER NOT NULL REFERENCES positions(id),
+  engine TEXT NOT NULL,
+  user TEXT NOT NULL,
+  depth INTEGER NOT NULL,
+  file TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS lines (
+  analysis_id INTEGER NOT NULL REFERENCES analyses(id),
+  move TEXT NOT NULL,
+  eval INTEGER NOT NULL,
+  depth INTEGER NOT NULL,
+  pv TEXT);
+CREATE INDEX IF NOT EXISTS positions_sheet_index ON positions(sheet_index);
+CREATE INDEX IF NOT EXISTS analyses_position ON analyses(position_id);
+CREATE INDEX IF NOT EXISTS analyses_engine_depth ON analyses(engine, depth);
+CREATE INDEX IF NOT EXISTS lines_analysis ON lines(analysis_id);
+CREATE VIEW IF NOT EXISTS lines_view AS
+  SELECT p.sheet_index AS "index", p.epd, l.move, l.eval, l.depth, l.pv,
+         a.engine, a.user, a.file
+  FROM lines l JOIN analyses a ON a.id = l.analysis_id
+  JOIN positions p ON p.id = a.position_id;
+'''
+
+
+def open_store(fname: str):
+    """Returns the sqlite connection of the store, the tables are created if not found."""
+    con = sqlite3.connect(fname)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('PRAGMA synchronous=NORMAL')
+    con.executescript(SCHEMA)
+    con.commit()
+    return con
+
+
+def get_position_id(con, epd: str, sheet_index) -> int:
+    """Returns the key of the epd, the position is added if not found."""
+    row = con.execute('SELECT id, sheet_index FROM positions WHERE epd = ?', (epd,)).fetchone()
+    if row is None:
+        return con.execute('INSERT INTO positions (epd, sheet_index) VALUES (?, ?)',
+                           (epd, sheet_index)).lastrowid
+    if row[1] is None and sheet_index is not None:
+        con.execute('UPDATE positions SET sheet_index = ? WHERE id = ?', (sheet_index, row[0]))
+    return row[0]
+
+
+def add_analysis(con, epd: str, sheet_index, user: str, depth: int, engine: str,
+                 lines: list, file: str, commit: bool = True):
+    """Saves the multipv lines of an analysis.
+
+    An earlier analysis from the same file is replaced, so a file can be
+    imported again.
+
+    Args:
+      sheet_index: The index of the position in the sts_positions google
+        sheet, None if it is not known.
+      lines: List of (move, eval, depth, pv).
+      file: The csv filename of the analysis.
+    """
+    position_id = get_position_id(con, epd, sheet_index)
+    row = con.execute('SELECT id FROM analyses WHERE file = ?', (file,)).fetchone()
+    if row is not None:
+        con.execute('DELETE FROM lines WHERE analysis_id = ?', (row[0],))
+        con.execute('DELETE FROM analyses WHERE id = ?', (row[0],))
+
+    analysis_id = con.execute(
+        'INSERT INTO analyses (position_id, engine, user, depth, file) VALUES (?, ?, ?, ?, ?)',
+        (position_id, engine, user, depth, file)).lastrowid
+    con.executemany('INSERT INTO lines (analysis_id, move, eval, depth, pv) VALUES (?, ?, ?, ?, ?)',
+                    [(analysis_id,) + tuple(line) for line in lines])
+    if commit:
+        con.commit()
+
+
+def import_csv(con, path: str, commit: bool = True) -> bool:
+    """Saves an index_{index}_d{depth}_{user}.csv file of analyze.py.
+
+    Returns False if the file is not an analysis file.
+    """
+    fn = os.path.basename(path)
+    match = CSV_NAME_RE.match(fn)
+    if match is None:
+        return False
+
+    index, depth, user = match.groups()
+    sheet_index = int(index) if index.isdigit() else None
+
+    try:
+        with open(path, encoding='utf-8', newline='') as handle:
+            rows = list(csv.DictReader(handle))
+        lines = [(row['move'], int(row['eval']), int(row['depth']), row['pv']) for row in rows]
+        epd, engine = rows[0]['epd'], rows[0]['engine']
+    except (OSError, IndexError, KeyError, ValueError):
+        logging.warning('Analysis file %s is not valid.', path)
+        return False
+
+    add_analysis(con, epd, sheet_index, user, int(depth), engine, lines, fn, commit)
+    return True
+
+
+def import_paths(con, paths: list) -> int:
+    """Saves the csv files and the csv files in the folders of paths.
+
+    Returns the number of files saved.
+    """
+    num_files = 0
+    for path in paths:
+        if os.path.isdir(path):
+            fnames = [os.path.join(path, fn) for fn in sorted(os.listdir(path))]
+        else:
+            fnames = [path]
+        for fname in fnames:
+            num_files += import_csv(con, fname, commit=False)
+    con.commit()
+    return num_files
+
+
+def query(con, depth: int = None, min_depth: int = None, engine: str = None,
+          user: str = None, index: int = None) -> list:
+    """Returns the rows of lines_view that match all the given values."""
+    where, params = [], []
+    for column, op, value in (('a.depth', '=', depth), ('a.depth', '>=', min_depth),
+                              ('a.engine', '=', engine), ('a.user', '=', user),
+                              ('p.sheet_index', '=', index)):
+        if value is not None:
+            where.append(f'{column} {op} ?')
+            params.append(value)
+
+    sql = ('SELECT p.sheet_index, p.epd, l.move, l.eval, l.depth, l.pv, a.engine, a.user, a.file '
+           'FROM analyses a JOIN positions p ON p.id = a.position_id '
+           'JOIN lines l ON l.analysis_id = a.id')
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY p.sheet_index, a.id, l.eval DESC, l.depth DESC'
+    return con.execute(sql, params).fetchall()
+
+
+def read_store_index(con) -> dict:
+    """Returns the analyses in the store like analyze.read_analysis_index()."""
+    analyzed = {}
+    for epd, depth, engine, multipv, file in con.execute(
+            'SELECT p.epd, a.depth, a.engine, COUNT(*), a.file FROM analyses a '
+            'JOIN positions p ON p.id = a.position_id '
+            'JOIN lines l ON l.analysis_id = a.id GROUP BY a.id'):
+        analyzed.setdefault(epd, []).append(
+            {'depth': depth, 'engine': engine, 'multipv': multipv, 'file': file})
+    return analyzed
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--store', required=False, type=str, default=STORE_FN,
+                        help=f'The sqlite filename (not required, default={STORE_FN}).')
+
+    parser = argparse.ArgumentParser(description='Keep the analysis csv files in one sqlite file.')
+    parser.add_argument('-v', '--version', action='version', version=f'{__version__}')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = commands.add_parser('import', parents=[common],
+                                        help='Save analysis csv files in the store.')
+    import_parser.add_argument('paths', nargs='+',
+                               help='The csv files or folders of csv files, e.g. ../analysis')
+
+    query_parser = commands.add_parser('query', parents=[common],
+                                       help='Write the matching lines as csv.')
+    query_parser.add_argument('--depth', type=int, help='The analysis depth.')
+    query_parser.add_argument('--min-depth', type=int, help='The minimum analysis depth.')
+    query_parser.add_argument('--engine', type=str, help='The engine id name.')
+    query_parser.add_argument('--user', type=str, help='The username of the analysis.')
+    query_parser.add_argument('--index', type=int, help='The position index.')
+    query_parser.add_argument('--output', type=str,
+                              help='The output csv filename (not required, default=stdout).')
+
+    args = parser.parse_args()
+    con = open_store(args.store)
+
+    if args.command == 'import':
+        num_files = import_paths(con, args.paths)
+        print(f'{num_files} files are saved in {args.store}')
+    else:
+        rows = query(con, args.depth, args.min_depth, args.engine, args.user, args.index)
+        handle = sys.stdout if args.output is None else open(args.output, 'w', newline='',
+                                                             encoding='utf-8')
+        writer = csv.writer(handle)
+        writer.writerow(QUERY_FIELDS)
+        writer.writerows(rows)
+        if args.output is not None:
+            handle.close()
+
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
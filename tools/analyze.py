@@ -1,6 +1,7 @@
 """Analyze position with engine.
 
-Save the analysis to csv file.
+Save the analysis to csv file. The engine is driven by sts_engine.py
+from the parent folder.
 
 Requirements:
   pip install chess
@@ -8,21 +9,39 @@ Requirements:
 """
 
 
-__version__ = '0.8.0'
+__version__ = '0.13.1'
 
 
 import argparse
+import asyncio
+import csv
 import logging
+import os
+import re
+import sys
 import time
 import json
 import secrets
 import string
 
-import chess.engine
+import chess
 import pandas as pd
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sts_engine import EngineSession, EngineError, get_deadline  # noqa: E402
+from sts_positions import load_position_index, get_position_key  # noqa: E402
+from analysis_store import open_store, add_analysis, read_store_index  # noqa: E402
+
 
 ALPHABET = string.ascii_lowercase + string.digits
+MATE_SCORE = 32000
+SEARCH_TIMEOUT_MARGIN = 10  # sec, added to the move time before the engine is considered as hung
+SEARCH_TIMEOUT_DEPTH = 7200  # sec, the search to the depth of an engine that is not hung
+MAX_TRIES = 3  # a position that crashes or hangs the engine this many times is not analyzed
+TIME_FILE = 'analyze_time.json'  # analysis time of every index, used to order the positions
+DEPTH_TIME_FACTOR = 1.6  # time growth per depth, to scale the time of a previous depth
+CSV_NAME_RE = re.compile(r'^index_(\w+)_d(\d+)_.*\.csv$')
 
 
 def get_random_index() -> str:
@@ -31,10 +50,11 @@ def get_random_index() -> str:
     return ''.join(secrets.choice(ALPHABET) for _ in range(8))
 
 
-def set_engine_options(engine, engine_option, hashmb, threads):
+async def set_engine_options(session, engine_option, hashmb, threads, multipv):
     """Sets engine options.
     """
     is_hash_set, is_thread_set = False, False
+    options = {o.lower() for o in session.options}
     if engine_option is not None:
         opt_list = engine_option.split(',')
         for optv in opt_list:
@@ -42,11 +62,11 @@ def set_engine_options(engine, engine_option, hashmb, threads):
             name = opt.split('=')[0].strip()
             value = opt.split('=')[1].strip()
 
-            if name not in engine.options:
+            if name.lower() not in options:
                 logging.warning('option %s is not supported by the engine', name)
                 continue
 
-            engine.configure({name: value})
+            await session.setoption(name, value)
             logging.debug('%s is set to %s', name, value)
 
             if name.lower() == 'hash':
@@ -55,56 +75,329 @@ def set_engine_options(engine, engine_option, hashmb, threads):
                 is_thread_set = True
 
     if not is_hash_set:
-        engine.configure({'Hash': hashmb})
+        await session.setoption('Hash', hashmb)
     if not is_thread_set:
-        engine.configure({'Threads': threads})
-
-
-def read_epd_index() -> dict:
-    """Reads json file and return as a dict.
-
-    analyze.py and epd_index.json should be in same folder.
-    """
-    with open('epd_index.json', encoding='utf-8') as handle:
-        data = json.load(handle)
-        return data
+        await session.setoption('Threads', threads)
+    await session.setoption('MultiPV', multipv)
 
 
 def get_epd(epd_file) -> list:
-    """Converts epd's in epd file into a list."""
+    """Converts epd's in epd file into a list, the opcodes are not included."""
     epds = []
     with open(epd_file, encoding='utf-8') as handle:
         for lines in handle:
-            epd_line = lines.rstrip()
-            epds.append(epd_line)
+            epd_line = ' '.join(lines.split()[0:4])
+            if epd_line:
+                epds.append(epd_line)
 
     return epds
 
 
+def parse_pv_info(line) -> dict:
+    """Gets the multipv, depth, score and pv of a uci info line.
+
+    The score is from the side to move, a mate score is converted to
+    MATE_SCORE minus the number of moves. Returns None if the line has
+    no pv or score.
+    """
+    tokens = line.split()
+    info = {'multipv': 1}
+    i = 1
+    while i < len(tokens):
+        token = tokens[i]
+        if token in ('depth', 'multipv'):
+            info[token] = int(tokens[i+1])
+            i += 2
+        elif token == 'score':
+            kind, value = tokens[i+1], int(tokens[i+2])
+            if kind == 'cp':
+                info['score'] = value
+            elif value > 0:
+                info['score'] = MATE_SCORE - value
+            else:
+                info['score'] = -MATE_SCORE - value
+            i += 3
+        elif token == 'pv':
+            info['pv'] = tokens[i+1:]
+            break
+        elif token == 'string':
+            return None
+        else:
+            i += 1
+
+    if 'pv' not in info or 'score' not in info or 'depth' not in info:
+        return None
+    return info
+
+
+async def analyse(session, fen, go_limit, timeout) -> list:
+    """Searches the position, returns the last info of every multipv line.
+
+    Args:
+      go_limit: The uci go command limit, e.g. 'depth 20' or 'movetime 600000'.
+      timeout: Time in sec to wait for the bestmove, None to wait without limit.
+    """
+    await session.send('ucinewgame')
+    await session.isready()
+    await session.send(f'position fen {fen}')
+    await session.send(f'go {go_limit}')
+
+    deadline = get_deadline(timeout)
+    engine_info = {}
+    while True:
+        line = await session.readline(deadline)
+        if line.startswith('bestmove'):
+            break
+        if line.startswith('info'):
+            info = parse_pv_info(line)
+            if info is not None:
+                engine_info[info['multipv']] = info
+
+    return [engine_info[k] for k in sorted(engine_info)]
+
+
 def get_analysis_data(engine_info, num_moves, epd, engine_name) -> list:
     """Gets engine analysis.
     """
     data = []
-    for i in range(num_moves):
-        move = engine_info[i]['pv'][0]
-        eval_ = engine_info[i]['score'].relative.score(mate_score=32000)
-        depth = engine_info[i]['depth']
+    rdepth = 0
+    for i, info in enumerate(engine_info[0:num_moves]):
+        move = info['pv'][0]
+        eval_ = info['score']
+        depth = info['depth']
 
-        pv = engine_info[i]['pv'][0:7]
-        pv1 = [a.uci() for a in pv]
-        pv2 = ' '.join(pv1)
+        pv2 = ' '.join(info['pv'][0:7])
 
         if i == 0:
             rdepth = depth
 
-        data.append([epd, move.uci(), eval_, depth, pv2, engine_name])
+        data.append([epd, move, eval_, depth, pv2, engine_name])
 
     return data, rdepth
 
 
-def analyze(enginefn: str, epd: str, epd_file: str, depth: int,
+def read_analysis_index(folders: list) -> dict:
+    """Returns the existing analyses of the csv files in folders.
+
+    The csv files are the output of this program. The key is the position
+    key of the epd from the csv, the value is a list of dict with the
+    depth, engine, multipv and filename of every file of that epd.
+    """
+    analyzed = {}
+    for folder in folders:
+        try:
+            fnames = sorted(os.listdir(folder))
+        except OSError:
+            logging.warning('Analysis folder %s is not found.', folder)
+            continue
+
+        for fn in fnames:
+            if CSV_NAME_RE.match(fn) is None:
+                continue
+            path = os.path.join(folder, fn)
+            try:
+                with open(path, encoding='utf-8', newline='') as handle:
+                    rows = list(csv.DictReader(handle))
+                key = get_position_key(rows[0]['epd'])
+                depth = max(int(row['depth']) for row in rows)
+                engine = rows[0]['engine']
+            except (OSError, IndexError, KeyError, ValueError):
+                logging.warning('Analysis file %s is not valid.', path)
+                continue
+
+            analyzed.setdefault(key, []).append(
+                {'depth': depth, 'engine': engine, 'multipv': len(rows), 'file': path})
+
+    return analyzed
+
+
+def get_covering_analysis(analyzed: dict, key: str, engine_name: str, depth: int,
+                          num_moves: int):
+    """Returns an analysis of the position key by the engine at depth or more, None if none."""
+    for entry in analyzed.get(key, []):
+        if (entry['engine'] == engine_name and entry['depth'] >= depth
+                and entry['multipv'] >= num_moves):
+            return entry
+    return None
+
+
+def read_analysis_time() -> dict:
+    """Reads the depth and time in sec of previous analyses of every index."""
+    try:
+        with open(TIME_FILE, encoding='utf-8') as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_analysis_time(data: dict):
+    """Saves the depth and time in sec of the analyses of every index."""
+    with open(TIME_FILE, 'w', encoding='utf-8') as handle:
+        json.dump(data, handle)
+
+
+def get_expected_time(prev, depth: int, move_time_sec: int):
+    """Returns the expected analysis time in sec, None if not known.
+
+    Args:
+      prev: The {'depth': d, 'sec': t} of a previous analysis or None.
+    """
+    if move_time_sec:
+        return move_time_sec
+    if prev is None:
+        return None
+    return prev['sec'] * DEPTH_TIME_FACTOR ** (depth - prev['depth'])
+
+
+def get_jobs(epds: list, positions, depth: int, move_time_sec: int, prev_time: dict) -> list:
+    """Returns the (epd, index, tries) to analyze, longest expected time first.
+
+    The index is the sheet index of the position from the PositionIndex
+    positions. Positions without a previous analysis time get the average
+    time.
+    """
+    jobs = []
+    for pos in epds:
+        entry = positions.lookup(pos)
+        if entry is not None and entry.sheet_index is not None:
+            index_num = entry.sheet_index
+        else:
+            logging.warning('Position %s is not in the sts positions. Temp index will be used.',
+                            pos)
+            index_num = get_random_index()
+        expected = get_expected_time(prev_time.get(str(index_num)), depth, move_time_sec)
+        jobs.append([expected, pos, index_num])
+
+    known = [job[0] for job in jobs if job[0] is not None]
+    average = sum(known) / len(known) if known else 0
+    for job in jobs:
+        if job[0] is None:
+            job[0] = average
+
+    # sorted() is stable, positions with the same time keep the file order.
+    jobs = sorted(jobs, key=lambda job: job[0], reverse=True)
+    return [(pos, index_num, 0) for _, pos, index_num in jobs]
+
+
+async def start_session(worker: int, enginefn: str, hashmb: int, threads: int, multipv: int,
+                        engine_option: str):
+    """Runs the engine of a worker and sets its options, returns the EngineSession."""
+    session = EngineSession(enginefn, log=lambda line: logging.debug('%d %s', worker, line))
+    await session.start()
+    try:
+        await session.uci()
+        await set_engine_options(session, engine_option, hashmb, threads, multipv)
+    except EngineError:
+        await session.quit()
+        raise
+    return session
+
+
+async def analyze_worker(worker: int, enginefn: str, jobs: list, go_limit: str, timeout,
+                         hashmb: int, threads: int, multipv: int, engine_option: str,
+                         username: str, analysis_time: dict, depth: int, analyzed, store,
+                         failed: list):
+    """Runs an engine and analyzes positions from jobs until it is empty.
+
+    The csv file of a position is written as soon as its analysis is done.
+    A position is skipped if analyzed has its analysis by the same engine
+    at depth or more, analyzed is None to analyze all positions. The
+    analysis is also saved in the store if it is not None.
+
+    If the engine terminates or hangs it is restarted and the position is
+    put back in jobs, after MAX_TRIES it is added to failed. The worker
+    stops if its engine cannot be restarted, the other workers continue.
+    """
+    session = None
+    try:
+        while jobs:
+            pos, index_num, tries = jobs.pop(0)
+
+            if session is None:
+                try:
+                    session = await start_session(worker, enginefn, hashmb, threads, multipv,
+                                                  engine_option)
+                except EngineError as err:
+                    logging.error('worker: %d, cannot start the engine: %s', worker, err)
+                    print(f'worker: {worker}, cannot start the engine: {err}')
+                    jobs.insert(0, (pos, index_num, tries))
+                    return
+            engine_name = session.id_name
+
+            logging.info('worker: %d, epd: %s, index: %s', worker, pos, str(index_num))
+            print(f'worker: {worker}, epd: {pos}, index: {index_num}')
+
+            board = chess.Board(pos)
+            num_moves = min(multipv, board.legal_moves.count())
+            adepth = 0  # for csv filename depth info
+
+            if analyzed is not None:
+                done = get_covering_analysis(analyzed, get_position_key(pos), engine_name,
+                                             depth, num_moves)
+                if done is not None:
+                    logging.info('worker: %d, index: %s is skipped, analyzed in %s',
+                                 worker, str(index_num), done['file'])
+                    print(f'worker: {worker}, index: {index_num}, skipped, '
+                          f'analyzed in {done["file"]}')
+                    continue
+
+            time_start = time.perf_counter()
+
+            try:
+                engine_info = await analyse(session, board.fen(), go_limit, timeout)
+            except EngineError as err:
+                logging.error('worker: %d, index: %s, %s, the engine is restarted',
+                              worker, str(index_num), err)
+                print(f'worker: {worker}, index: {index_num}, {err}, the engine is restarted')
+                session.kill()
+                await session.quit()
+                session = None
+                if tries + 1 < MAX_TRIES:
+                    jobs.append((pos, index_num, tries + 1))
+                else:
+                    failed.append((pos, index_num))
+                continue
+
+            data, adepth = get_analysis_data(engine_info, num_moves, pos, engine_name)
+
+            time_end = time.perf_counter()
+            print(f'worker: {worker}, index: {index_num}, '
+                  f'elapse (sec): {time_end - time_start:0.1f}')
+
+            df = pd.DataFrame(data)
+            df.columns = ['epd', 'move', 'eval', 'depth', 'pv', 'engine']
+
+            # Sort by score and depth
+            df = df.sort_values(by=['eval', 'depth'], ascending=[False, False])
+
+            # Build an output filename.
+            output = f'index_{index_num}_d{adepth}_{username}.csv'
+            df.to_csv(output, index=False)
+
+            if store is not None:
+                sheet_index = index_num if isinstance(index_num, int) else None
+                lines = [(r.move, int(r.eval), int(r.depth), r.pv)
+                         for r in df.itertuples(index=False)]
+                add_analysis(store, pos, sheet_index, username, adepth, engine_name, lines, output)
+
+            if analyzed is not None:
+                analyzed.setdefault(get_position_key(pos), []).append(
+                    {'depth': adepth, 'engine': engine_name, 'multipv': len(df), 'file': output})
+
+            if isinstance(index_num, int):
+                analysis_time[str(index_num)] = {'depth': adepth,
+                                                 'sec': round(time_end - time_start, 3)}
+                save_analysis_time(analysis_time)
+    finally:
+        if session is not None:
+            await session.quit()
+
+
+async def analyze(enginefn: str, epd: str, epd_file: str, depth: int,
             hashmb: int, threads: int, multipv: int,
-            engine_option: str, username: str, move_time_sec: int):
+            engine_option: str, username: str, move_time_sec: int,
+            workers: int = 1, analysis_dirs: list = None, reanalyze: bool = False,
+            store_fn: str = None, search_timeout_sec: int = SEARCH_TIMEOUT_DEPTH):
     """Analyzes the epd or positions in the epd file.
 
     Position will be analyzed by an engine run at multipv 10. The
@@ -112,17 +405,28 @@ def analyze(enginefn: str, epd: str, epd_file: str, depth: int,
 
     Args:
       enginefn: The engine filename or path/filename.
+      hashmb: The total hash of all workers in mb.
+      threads: The total threads of all workers.
+      workers: The number of engine processes. Each gets an equal part
+        of the hash and threads and takes the next position when it is
+        done, the positions that took longest before are first.
+      analysis_dirs: The folders of the csv files of earlier analyses,
+        the current folder is always included.
+      reanalyze: Analyze the positions that are already analyzed by the
+        same engine at the same or higher depth.
+      store_fn: The sqlite file of analysis_store.py where the analysis
+        is also saved, its analyses are used like the csv files.
+      search_timeout_sec: The time an engine gets to reach the depth when
+        there is no move time, after it the engine is considered as hung.
     """
-    engine = chess.engine.SimpleEngine.popen_uci(enginefn)
-    engine_name = engine.id['name']
-    set_engine_options(engine, engine_option, hashmb, threads)
-
-    epi = read_epd_index()
+    positions = load_position_index()
 
     if move_time_sec:
-        limit = chess.engine.Limit(time=move_time_sec)
+        go_limit = f'movetime {1000 * move_time_sec}'
+        timeout = move_time_sec + SEARCH_TIMEOUT_MARGIN
     else:
-        limit = chess.engine.Limit(depth=depth)
+        go_limit = f'depth {depth}'
+        timeout = search_timeout_sec
 
     epds = []
     if epd is not None:
@@ -130,39 +434,42 @@ def analyze(enginefn: str, epd: str, epd_file: str, depth: int,
     else:
         epds = get_epd(epd_file)
 
-    for pos in epds:
-        try:
-            index_num = epi[pos]
-        except KeyError:
-            logging.warning('Position %s is not in epd_index.json. Temp index will be used.', pos)
-            index_num = get_random_index()
-
-        logging.info('epd: %s, index: %s', pos, str(index_num))
-        print(f'epd: {pos}, index: {index_num}')
-
-        board = chess.Board(pos)
-        num_moves = min(multipv, board.legal_moves.count())
-        adepth = 0  # for csv filename depth info
-
-        time_start = time.perf_counter()
-
-        engine_info = engine.analyse(board, limit=limit, multipv=multipv)
-        data, adepth = get_analysis_data(engine_info, num_moves, pos, engine_name)
-
-        time_end = time.perf_counter()
-        print(f'elapse (sec): {time_end - time_start:0.1f}')
-
-        df = pd.DataFrame(data)
-        df.columns = ['epd', 'move', 'eval', 'depth', 'pv', 'engine']
-
-        # Sort by score and depth
-        df = df.sort_values(by=['eval', 'depth'], ascending=[False, False])
-
-        # Build an output filename.
-        output = f'index_{index_num}_d{adepth}_{username}.csv'
-        df.to_csv(output, index=False)
-
-    engine.quit()
+    store = None if store_fn is None else open_store(store_fn)
+
+    analyzed = None
+    if not reanalyze:
+        analyzed = read_analysis_index(['.'] + (analysis_dirs or []))
+        if store is not None:
+            for epd, entries in read_store_index(store).items():
+                analyzed.setdefault(get_position_key(epd), []).extend(entries)
+
+    analysis_time = read_analysis_time()
+    jobs = get_jobs(epds, positions, depth, move_time_sec, analysis_time)
+
+    workers = max(1, min(workers, len(jobs)))
+    worker_hash = max(16, hashmb // workers)
+    worker_threads = max(1, threads // workers)
+    if workers > 1:
+        print(f'workers: {workers}, hash: {worker_hash}, threads: {worker_threads}')
+
+    failed = []
+    try:
+        await asyncio.gather(*[analyze_worker(i + 1, enginefn, jobs, go_limit, timeout,
+                                              worker_hash, worker_threads, multipv,
+                                              engine_option, username, analysis_time,
+                                              depth, analyzed, store, failed)
+                               for i in range(workers)])
+    finally:
+        if store is not None:
+            store.close()
+
+    # Positions that failed and those that are left when no engine can be started
+    not_analyzed = failed + [(pos, index_num) for pos, index_num, _ in jobs]
+    for pos, index_num in not_analyzed:
+        logging.warning('Position %s, index: %s is not analyzed.', pos, str(index_num))
+    if not_analyzed:
+        print(f'Warning, {len(not_analyzed)} positions were not analyzed: '
+              f'{", ".join(str(index_num) for _, index_num in not_analyzed)}')
 
 
 def main():
@@ -182,9 +489,11 @@ def main():
     parser.add_argument('--engine', required=True, type=str,
                         help='The engine file (required).')
     parser.add_argument('--hash-mb', required=False, type=int, default=128,
-                        help='The engine hash size in mb (not required, default=128).')
+                        help='The engine hash size in mb, the total of all --workers '
+                        '(not required, default=128).')
     parser.add_argument('--threads', required=False, type=int, default=1,
-                        help='The engine number of threads to use (not required, default=1).')
+                        help='The engine number of threads to use, the total of all --workers '
+                        '(not required, default=1).')
     parser.add_argument('--depth', required=False, type=int, default=20,
                         help='The analysis depth (not required, default=20).')
     parser.add_argument(
@@ -194,8 +503,28 @@ def main():
              'on depth and this option. If the depth is reached first and we still have time '
              'then continue the analysis until move time is reached. If depth is not yet reached '
              'and time is already reached, then save and abort the analysis')
+    parser.add_argument('--search-timeout-sec', required=False, type=int,
+                        default=SEARCH_TIMEOUT_DEPTH,
+                        help='The time in seconds to reach the --depth when there is no '
+                        '--move-time-sec, after it the engine is considered as hung, restarted '
+                        'and the position is tried again '
+                        f'(not required, default={SEARCH_TIMEOUT_DEPTH}).')
     parser.add_argument('--multipv', required=False, type=int, default=10,
                         help='The multipv value the engine will be run (not required, default=10).')
+    parser.add_argument('--workers', required=False, type=int, default=1,
+                        help='The number of engine processes, the --hash-mb and --threads '
+                        'are divided among them (not required, default=1).')
+    parser.add_argument('--analysis-dir', required=False, type=str, action='append',
+                        help='A folder with the csv files of earlier analyses, can be repeated '
+                        '(not required). The csv files in the current folder are always used. '
+                        'A position is skipped if it is already analyzed by the same engine '
+                        'at --depth or more, e.g. --analysis-dir ../analysis')
+    parser.add_argument('--reanalyze', action='store_true',
+                        help='Analyze all positions even if they are already analyzed '
+                        '(not required).')
+    parser.add_argument('--store', required=False, type=str,
+                        help='The sqlite file of analysis_store.py, the analysis of every position '
+                        'is also saved there (not required), e.g. --store analysis.db')
     parser.add_argument('--log-file', required=False, type=str,
                         help='The log filename, (not required) e.g. --log-file sf15_log.txt. '
                         'Write mode is append if --epd-file is defined otherwise overwrite.')
@@ -217,9 +546,11 @@ def main():
     if move_time_sec is not None:
         move_time_sec = int(move_time_sec)
 
-    analyze(args.engine, args.epd, args.epd_file, args.depth,
-            args.hash_mb, args.threads, args.multipv,
-            args.engine_option, args.username, move_time_sec)
+    asyncio.run(analyze(args.engine, args.epd, args.epd_file, args.depth,
+                        args.hash_mb, args.threads, args.multipv,
+                        args.engine_option, args.username, move_time_sec,
+                        args.workers, args.analysis_dir, args.reanalyze, args.store,
+                        args.search_timeout_sec))
 
 
 if __name__ == '__main__':
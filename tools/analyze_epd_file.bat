@@ -5,9 +5,8 @@ rem The positions to be analyzed are in the epd file.
 rem The csv analysis output will be saved automatically with filename:
 rem index_[index_number]_d[depth]_[username].csv
 
-rem The file epd_index.json should be located in the same location
-rem with analyze.py. The index number will be taken from this file
-rem based fom the given epd.
+rem The index number is taken from the epd files in the epd folder
+rem of the parent folder of analyze.py, see sts_positions.py.
 
 rem Use analyze.py version >= 0.7
 
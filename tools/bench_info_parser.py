@@ -0,0 +1,106 @@
+"""Micro-benchmark of the uci info line parser of sts_rating.py.
+
+Compares the previous parsing code of the analyze_pos loop, which used
+substring checks and several split calls per line, with parse_info_line
+on every line and with the info line handling of read_answer, which
+keeps the last lines with a score, time and nodes and parses them once
+after the best move.
+
+Usage:
+  python bench_info_parser.py
+"""
+
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sts_rating import parse_info_line, LastInfo  # noqa: E402
+
+
+# Typical output of Stockfish at short movetime.
+INFO_LINES = [
+    'info string NNUE evaluation using nn-6877cd24400e.nnue enabled',
+    'info depth 1 seldepth 1 multipv 1 score cp 112 nodes 35 nps 35000 tbhits 0 time 1 pv f4f5',
+    'info depth 2 seldepth 2 multipv 1 score cp 148 nodes 118 nps 118000 tbhits 0 time 1 pv f4f5 e6f5',
+    'info depth 10 currmove f4f5 currmovenumber 1',
+    'info depth 10 currmove d4f2 currmovenumber 2',
+    'info depth 10 currmove f3g4 currmovenumber 3',
+    'info depth 10 seldepth 14 multipv 1 score cp 160 lowerbound nodes 15231 nps 507700 '
+    'hashfull 4 tbhits 0 time 30 pv f4f5',
+    'info depth 12 seldepth 18 multipv 1 score cp 155 nodes 45512 nps 520137 hashfull 15 '
+    'tbhits 0 time 87 pv f4f5 e6f5 f3d5 d7e5 d4e5 a6e2',
+    'info depth 14 seldepth 20 multipv 1 score mate 7 nodes 95512 nps 530620 hashfull 31 '
+    'tbhits 0 time 180 pv f4f5 e6f5 f3d5 d7e5 d4e5 a6e2 d1d2',
+    'info nodes 100000 nps 531914 hashfull 33 tbhits 0 time 188',
+]
+
+
+def legacy_parse(eline):
+    """The parsing code of analyze_pos before parse_info_line."""
+    etime = escore = emate = esdepth = emdepth = None
+    if "time" in eline and "info" in eline:
+        a = eline.strip()
+        a = a.split(" ")
+        i = a.index("time")
+        etime = a[i+1].strip()
+        etime = int(etime)
+
+    if "score cp" in eline:
+        a = eline.strip().split(" ")
+        i = a.index("cp")
+        escore = a[i+1].strip()
+        escore = int(escore)
+
+        if "depth" in eline:
+            a = eline.strip().split(" ")
+            i = a.index("depth")
+            esdepth = a[i+1].strip()
+            esdepth = int(esdepth)
+
+    elif "score mate" in eline:
+        a = eline.strip().split(" ")
+        i = a.index("mate")
+        emate = a[i+1].strip()
+        emate = int(emate)
+
+        if "depth" in eline:
+            a = eline.strip().split(" ")
+            i = a.index("depth")
+            emdepth = a[i+1].strip()
+            emdepth = int(emdepth)
+
+    return etime, escore, emate, esdepth, emdepth
+
+
+def legacy_output(lines):
+    """Parses every line with the previous code."""
+    return [legacy_parse(line) for line in lines]
+
+
+def parse_output(lines):
+    """Parses every info line with parse_info_line."""
+    return [parse_info_line(line) for line in lines if line.startswith('info')]
+
+
+def read_answer_output(lines):
+    """The info line handling of read_answer."""
+    last_info = LastInfo()
+    for line in lines:
+        if line.startswith('info') and not line.startswith('info string'):
+            last_info.add(line)
+    return last_info.get()
+
+
+def main():
+    number = 20000
+    for name, func in [('legacy', legacy_output), ('parse_info_line', parse_output),
+                       ('read_answer', read_answer_output)]:
+        t = min(timeit.repeat(lambda: func(INFO_LINES), number=number, repeat=5))
+        print(f'{name:16s}: {1e9 * t / (number * len(INFO_LINES)):7.0f} ns/line')
+
+
+if __name__ == '__main__':
+    main()
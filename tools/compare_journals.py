@@ -0,0 +1,83 @@
+"""Paired bootstrap comparison of two sts_rating.py journals.
+
+The journals are the <engine>_journal.jsonl files of two runs. Only the
+positions that are in both journals are compared. The two runs are
+resampled with the same positions, the output is the score percent and
+rating difference of A - B with the 95% interval.
+
+Requirements:
+  pip install numpy
+
+Usage:
+  python compare_journals.py sf_dev_journal.jsonl sf_base_journal.jsonl
+"""
+
+
+__version__ = '0.1.0'
+
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sts_rating import STS_ID, RATING_SLOPE, read_journal  # noqa: E402
+from sts_stats import bootstrap_paired  # noqa: E402
+
+
+def get_points(fname) -> tuple:
+    """Returns the max points and a dict of (sts, index, fen) to points of a journal."""
+    header, records = read_journal(fname)
+    if header is None:
+        raise ValueError(f'{fname} has no header')
+
+    points = {}
+    for rec in records:
+        # The first answer is used, as in --resume
+        points.setdefault((rec['sts'], rec['index'], rec['fen']), rec['points'])
+
+    return header['maxpoint'], points
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the STS results of two journals.')
+    parser.add_argument('journal_a', help='The journal of run A.')
+    parser.add_argument('journal_b', help='The journal of run B.')
+    parser.add_argument('--resamples', type=int, default=10000,
+                        help='The number of bootstrap resamples (not required, default=10000).')
+    parser.add_argument('-v', '--version', action='version', version=f'{__version__}')
+
+    args = parser.parse_args()
+
+    max_a, points_a = get_points(args.journal_a)
+    max_b, points_b = get_points(args.journal_b)
+    if max_a != max_b:
+        print(f'The max points are different, {max_a} and {max_b}')
+        sys.exit(1)
+
+    keys = sorted(points_a.keys() & points_b.keys())
+    if not keys:
+        print('The journals have no positions in common')
+        sys.exit(1)
+
+    theme_a = [[points_a[k] for k in keys if k[0] == sts] for sts in STS_ID]
+    theme_b = [[points_b[k] for k in keys if k[0] == sts] for sts in STS_ID]
+
+    try:
+        diff, (low, high), better = bootstrap_paired(theme_a, theme_b, max_a, args.resamples)
+    except ImportError as err:
+        print(err)
+        sys.exit(1)
+
+    print(f'A: {args.journal_a}')
+    print(f'B: {args.journal_b}')
+    print(f'Positions in both journals: {len(keys)}')
+    print(f'Score(%) difference A - B: {diff:+0.2f}, 95% interval: [{low:+0.2f}, {high:+0.2f}]')
+    print(f'Rating difference A - B  : {RATING_SLOPE * diff:+0.0f}, '
+          f'95% interval: [{RATING_SLOPE * low:+0.0f}, {RATING_SLOPE * high:+0.0f}]')
+    print(f'A is better in {100 * better:0.1f}% of {args.resamples} resamples')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""Make a new version of the sts epd file from the analysis.
+
+The bm, c0, c7, c8, c9 and Ae opcodes of every position of the previous
+epd file are made again from the multipv lines of the deepest analysis
+of the position. The uci moves are converted to san with python chess
+and the evals are mapped to points. Positions without analysis are
+written unchanged. The positions that changed are saved in a report.
+
+Requirements:
+  pip install chess
+
+Usage:
+  python make_epd.py ../epd/STS1-STS15_LAN_v6.epd --analysis-dir ../analysis
+"""
+
+
+__version__ = '0.2.0'
+
+
+import argparse
+import csv
+import os
+import re
+import sys
+
+import chess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from analysis_store import open_store, import_paths  # noqa: E402
+from sts_positions import get_position_key  # noqa: E402
+
+
+VERSION_RE = re.compile(r'^(.*_v)(\d+)\.epd$')
+REPORT_FIELDS = ['id', 'epd', 'change', 'old_bm', 'new_bm', 'old_c0', 'new_c0']
+
+
+def interpol(e: int, emin: int, emax: int, pmin: int, pmax: int) -> float:
+    """Gets the point from a given evaluation, see Evaluation/Point mapping in README.md."""
+    return ((e - emin) * (pmax - pmin)) / max(emax - emin, 0.001) + pmin
+
+
+def linear_points(evals: list, pmin: int, pmax: int, window: int) -> list:
+    """The best eval gets pmax, the lowest eval of the moves gets pmin."""
+    emin, emax = min(evals), max(evals)
+    if emin == emax:
+        return [pmax] * len(evals)
+    return [int(round(interpol(e, emin, emax, pmin, pmax), 0)) for e in evals]
+
+
+def window_points(evals: list, pmin: int, pmax: int, window: int) -> list:
+    """The best eval gets pmax, evals that are window cp or more below it get pmin."""
+    emax = max(evals)
+    emin = emax - window
+    return [int(round(interpol(max(e, emin), emin, emax, pmin, pmax), 0)) for e in evals]
+
+
+POINT_SCHEMES = {'linear': linear_points, 'window': window_points}
+
+
+def get_output_fn(prev_fn: str) -> str:
+    """Returns the epd filename with the next version that is not found in the folder.
+
+    STS1-STS15_LAN_v6.epd gives STS1-STS15_LAN_v7.epd.
+    """
+    folder, fn = os.path.split(prev_fn)
+    match = VERSION_RE.match(fn)
+    if match is None:
+        raise ValueError(f'{prev_fn} has no _v<number>.epd version')
+
+    prefix, version = match.group(1), int(match.group(2))
+    for other in os.listdir(folder or '.'):
+        other_match = VERSION_RE.match(other)
+        if other_match is not None and other_match.group(1) == prefix:
+            version = max(version, int(other_match.group(2)))
+
+    return os.path.join(folder, f'{prefix}{version + 1}.epd')
+
+
+def get_best_analyses(con, engine: str = None) -> dict:
+    """Returns a dict of position key and (engine, [(move, eval)]) of the deepest analysis.
+
+    The moves are sorted by eval. If two analyses have the same depth the
+    one that is saved last is used.
+    """
+    sql = 'SELECT a.id, p.epd, a.engine FROM analyses a JOIN positions p ON p.id = a.position_id'
+    params = ()
+    if engine is not None:
+        sql += ' WHERE a.engine = ?'
+        params = (engine,)
+    sql += ' ORDER BY a.depth, a.id'
+
+    best = {}
+    for analysis_id, epd, engine_name in con.execute(sql, params):
+        best[get_position_key(epd)] = (analysis_id, engine_name)
+
+    analyses = {}
+    for key, (analysis_id, engine_name) in best.items():
+        lines = con.execute('SELECT move, eval FROM lines WHERE analysis_id = ? '
+                            'ORDER BY eval DESC, depth DESC', (analysis_id,)).fetchall()
+        analyses[key] = (engine_name, lines)
+
+    return analyses
+
+
+def split_opcodes(operations: str) -> list:
+    """Returns a list of (opcode, operation) in the order of the epd line."""
+    ops = []
+    for op in operations.split(';'):
+        op = op.strip()
+        if op:
+            ops.append((op.partition(' ')[0], op))
+    return ops
+
+
+def get_operand(ops: list, name: str) -> str:
+    """Returns the operand of the opcode without quotes, an empty string if not found."""
+    for opcode, op in ops:
+        if opcode == name:
+            return op.partition(' ')[2].strip().strip('"')
+    return ''
+
+
+def make_position(line: str, analysis, top: int, scheme, pmin: int, pmax: int,
+                  window: int) -> str:
+    """Returns the epd line with the opcodes made from the analysis."""
+    a = line.split(' ', 4)
+    epd = ' '.join(a[0:4])
+    ops = split_opcodes(a[4] if len(a) > 4 else '')
+
+    engine_name, lines = analysis
+    lines = lines[:top]
+    board = chess.Board(epd + ' 0 1')
+    san_moves = [board.san(chess.Move.from_uci(move)) for move, _ in lines]
+    uci_moves = [move for move, _ in lines]
+    points = scheme([e for _, e in lines], pmin, pmax, window)
+
+    new_ops = {
+        'bm': f'bm {san_moves[0]}',
+        'c0': 'c0 "' + ', '.join(f'{m}={p}' for m, p in zip(san_moves, points)) + '"',
+        'c7': 'c7 "' + ' '.join(san_moves) + '"',
+        'c8': 'c8 "' + ' '.join(str(p) for p in points) + '"',
+        'c9': 'c9 "' + ' '.join(uci_moves) + '"',
+        'Ae': f'Ae "{engine_name}"',
+    }
+
+    # Keep the order of the opcodes, the new ones that are not found are added.
+    out = [new_ops.pop(opcode, op) for opcode, op in ops]
+    out.extend(new_ops.values())
+    return epd + ' ' + ' '.join(op + ';' for op in out)
+
+
+def make_epd(prev_fn: str, output_fn: str, report_fn: str, analyses: dict, top: int,
+             scheme, pmin: int, pmax: int, window: int) -> dict:
+    """Writes the new epd file and the report of the changes.
+
+    The previous epd file is read and the new one written one line at a
+    time. Returns the number of positions of every change.
+    """
+    counts = {'positions': 0, 'best move': 0, 'points': 0, 'unchanged': 0, 'no analysis': 0}
+    with open(prev_fn, encoding='utf-8') as prev, \
+            open(output_fn, 'w', encoding='utf-8', newline='\n') as out, \
+            open(report_fn, 'w', encoding='utf-8', newline='') as report:
+        writer = csv.DictWriter(report, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+
+        for line in prev:
+            line = line.strip()
+            if not line:
+                continue
+            counts['positions'] += 1
+
+            epd = ' '.join(line.split(' ', 4)[0:4])
+            analysis = analyses.get(get_position_key(epd))
+            if analysis is None or not analysis[1]:
+                counts['no analysis'] += 1
+                out.write(line + '\n')
+                continue
+
+            new_line = make_position(line, analysis, top, scheme, pmin, pmax, window)
+            out.write(new_line + '\n')
+
+            old_ops = split_opcodes(line.split(' ', 4)[4] if line.count(' ') >= 4 else '')
+            new_ops = split_opcodes(new_line.split(' ', 4)[4])
+            old_bm, new_bm = get_operand(old_ops, 'bm'), get_operand(new_ops, 'bm')
+            old_c0, new_c0 = get_operand(old_ops, 'c0'), get_operand(new_ops, 'c0')
+
+            if old_bm != new_bm:
+                change = 'best move'
+            elif old_c0 != new_c0:
+                change = 'points'
+            else:
+                counts['unchanged'] += 1
+                continue
+
+            counts[change] += 1
+            writer.writerow({'id': get_operand(old_ops, 'id'), 'epd': epd, 'change': change,
+                             'old_bm': old_bm, 'new_bm': new_bm,
+                             'old_c0': old_c0, 'new_c0': new_c0})
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Make a new version of the sts epd file '
+                                     'from the analysis.')
+    parser.add_argument('epd_file', help='The previous version of the epd file, '
+                        'e.g. ../epd/STS1-STS15_LAN_v6.epd')
+    parser.add_argument('--analysis-dir', required=False, type=str, action='append',
+                        help='A folder with the csv files of analyze.py, can be repeated.')
+    parser.add_argument('--store', required=False, type=str,
+                        help='The sqlite file of analysis_store.py (not required). The csv '
+                        'files of --analysis-dir are also imported into it.')
+    parser.add_argument('--engine', required=False, type=str,
+                        help='Only use the analysis of this engine id name (not required), '
+                        'e.g. --engine "Stockfish 15"')
+    parser.add_argument('--output', required=False, type=str,
+                        help='The new epd file (not required, default=the next version '
+                        'of the epd file in the same folder).')
+    parser.add_argument('--report', required=False, type=str,
+                        help='The csv file of the positions that changed (not required, '
+                        'default=<output>_changes.csv).')
+    parser.add_argument('--scheme', required=False, choices=sorted(POINT_SCHEMES),
+                        default='linear',
+                        help='linear maps the evals of the moves from the lowest to the best '
+                        'eval, window maps the evals from the best eval less --window to the '
+                        'best eval (not required, default=linear).')
+    parser.add_argument('--window', required=False, type=int, default=200,
+                        help='The eval window in cp of --scheme window '
+                        '(not required, default=200).')
+    parser.add_argument('--min-point', required=False, type=int, default=1,
+                        help='The point of the lowest eval (not required, default=1).')
+    parser.add_argument('--max-point', required=False, type=int, default=100,
+                        help='The point of the best move (not required, default=100).')
+    parser.add_argument('--top', required=False, type=int, default=10,
+                        help='The number of moves per position (not required, default=10).')
+    parser.add_argument('-v', '--version', action='version', version=f'{__version__}')
+
+    args = parser.parse_args()
+
+    if not args.analysis_dir and args.store is None:
+        print('Use --analysis-dir or --store to set the analysis.')
+        sys.exit(1)
+
+    # The csv files are read into a store in memory.
+    con = open_store(args.store or ':memory:')
+    if args.analysis_dir:
+        import_paths(con, args.analysis_dir)
+    analyses = get_best_analyses(con, args.engine)
+    con.close()
+
+    output_fn = args.output or get_output_fn(args.epd_file)
+    report_fn = args.report or os.path.splitext(output_fn)[0] + '_changes.csv'
+
+    counts = make_epd(args.epd_file, output_fn, report_fn, analyses, args.top,
+                      POINT_SCHEMES[args.scheme], args.min_point, args.max_point, args.window)
+
+    print(f'epd file: {output_fn}')
+    print(f'report  : {report_fn}')
+    for name, count in counts.items():
+        print(f'{name:<12}: {count}')
+
+
+if __name__ == '__main__':
+    main()